@@ -1,13 +1,26 @@
+import contextlib
 import datetime
+import functools
+import hashlib
 import re
+import resource
+import time
+import zlib
 import logging
-from nameko.rpc import rpc
-from nameko.events import event_handler
+import eventlet.event
+import eventlet.semaphore
+from nameko.rpc import rpc, Rpc
+from nameko.events import event_handler, EventDispatcher
+from nameko.timer import timer
 from nameko.dependency_providers import DependencyProvider
 import bson.json_util
+from bson.binary import Binary
 from nameko_mongodb.database import MongoDatabase
-from pymongo import ASCENDING
-import sqlparse
+from pymongo import ASCENDING, ReturnDocument, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+from pymongo.errors import CollectionInvalid
+from pymongo.read_preferences import PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+
+from application.services.pipeline import build_pipeline, find_stale, get_ancestors, get_dependencies
 
 _logger = logging.getLogger(__name__)
 
@@ -26,13 +39,596 @@ class MetadataServiceError(Exception):
     pass
 
 
+class LaneSaturated(MetadataServiceError):
+    pass
+
+
+_MISSING = object()
+
+
+def _ordered(test):
+    def wrapper(value, expected):
+        try:
+            return value is not _MISSING and test(value, expected)
+        except TypeError:
+            return False
+    return wrapper
+
+
+SELECTOR_OPERATORS = {
+    'eq': lambda value, expected: value == expected,
+    'ne': lambda value, expected: value != expected,
+    'in': lambda value, expected: value in expected,
+    'nin': lambda value, expected: value not in expected,
+    'gt': _ordered(lambda value, expected: value > expected),
+    'gte': _ordered(lambda value, expected: value >= expected),
+    'lt': _ordered(lambda value, expected: value < expected),
+    'lte': _ordered(lambda value, expected: value <= expected),
+    'exists': lambda value, expected: (value is not _MISSING) == bool(expected),
+    'regex': lambda value, expected: isinstance(value, str) and expected.search(value) is not None
+}
+
+
+def _resolve(payload, path):
+    value = payload
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return _MISSING
+        value = value[key]
+    return value
+
+
+def compile_selector(selector):
+    # A selector is a list of {'field', 'operator', 'value'} conditions which must all hold on the event payload
+    conditions = []
+    for condition in selector or []:
+        if not isinstance(condition, dict) or 'field' not in condition:
+            raise MetadataServiceError('Bad formatted selector condition: {}'.format(condition))
+
+        operator = condition.get('operator', 'eq')
+        if operator not in SELECTOR_OPERATORS:
+            raise MetadataServiceError('Unavailable selector operator {}'.format(operator))
+
+        expected = condition.get('value')
+        if operator in ('in', 'nin') and not isinstance(expected, list):
+            raise MetadataServiceError('Selector operator {} expects a list: {}'.format(operator, expected))
+
+        if operator == 'regex':
+            try:
+                expected = re.compile(expected)
+            except (re.error, TypeError):
+                raise MetadataServiceError('Bad formatted selector regex: {}'.format(expected))
+
+        conditions.append((condition['field'].split('.'), SELECTOR_OPERATORS[operator], expected))
+
+    def predicate(payload):
+        return all(test(_resolve(payload, path), expected) for path, test, expected in conditions)
+
+    return predicate
+
+
+_IN_FLIGHT = {}
+
+
+def single_flight(method):
+    # Concurrent calls with the same arguments wait for the first one and share its serialized result
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = bson.json_util.dumps([method.__name__, args, kwargs], sort_keys=True)
+
+        call = _IN_FLIGHT.get(key)
+        if call is not None:
+            return call.wait()
+
+        call = _IN_FLIGHT[key] = eventlet.event.Event()
+        try:
+            result = method(self, *args, **kwargs)
+        except Exception as exc:
+            call.send_exception(exc)
+            raise
+        else:
+            call.send(result)
+            return result
+        finally:
+            # The first call can also be killed, waiters must not be left blocked on an event never sent
+            if not call.ready():
+                call.send_exception(MetadataServiceError('Call of {} was interrupted'.format(method.__name__)))
+            del _IN_FLIGHT[key]
+
+    return wrapper
+
+
+def in_lane(name):
+    # Runs the entrypoint within one of the lanes of the worker_lanes dependency
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.worker_lanes.acquire(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class WorkerLanes(DependencyProvider):
+
+    LANES = {
+        'heavy': {'size': 4, 'max_waiting': 16},
+        'background': {'size': 2, 'max_waiting': None},
+        'write': {'size': 4, 'max_waiting': None},
+        'light': {'size': None, 'max_waiting': None}
+    }
+
+    def __init__(self, lanes=None):
+        self.lanes = lanes or self.LANES
+        self._configure()
+
+    def setup(self):
+        # The configuration is merged over the lanes so that a lane it leaves out keeps its defaults
+        lanes = {name: dict(lane) for name, lane in self.lanes.items()}
+        for name, lane in (self.container.config.get('WORKER_LANES') or {}).items():
+            lanes.setdefault(name, {}).update(lane or {})
+        self.lanes = lanes
+        self._configure()
+
+    def _configure(self):
+        self.semaphores = {name: eventlet.semaphore.Semaphore(lane['size']) for name, lane in self.lanes.items()
+                           if lane.get('size') is not None}
+        self.stats = {name: {'active': 0, 'waiting': 0, 'peak_waiting': 0, 'completed': 0, 'rejected': 0,
+                             'wait_time': 0.} for name in self.lanes}
+
+    def get_dependency(self, worker_ctx):
+        return self
+
+    @contextlib.contextmanager
+    def acquire(self, name):
+        if name not in self.lanes:
+            raise MetadataServiceError('Unknown worker lane {}'.format(name))
+
+        stats = self.stats[name]
+        semaphore = self.semaphores.get(name)
+        max_waiting = self.lanes[name].get('max_waiting')
+
+        # Rejecting beyond max_waiting keeps a burst of heavy calls from holding every worker of the container.
+        # Lanes serving events or writes have no max_waiting since a requeued event would be handled out of order
+        # and a rejected process record or table notification would miss a pipeline
+        if semaphore is not None and semaphore.locked() and max_waiting is not None \
+                and stats['waiting'] >= max_waiting:
+            stats['rejected'] += 1
+            raise LaneSaturated('Worker lane {} is saturated'.format(name))
+
+        start = time.monotonic()
+        stats['waiting'] += 1
+        stats['peak_waiting'] = max(stats['peak_waiting'], stats['waiting'])
+        try:
+            if semaphore is not None:
+                semaphore.acquire()
+        finally:
+            stats['waiting'] -= 1
+        stats['wait_time'] += time.monotonic() - start
+
+        stats['active'] += 1
+        try:
+            yield
+        finally:
+            stats['active'] -= 1
+            stats['completed'] += 1
+            if semaphore is not None:
+                semaphore.release()
+
+    def get_stats(self):
+        return {name: dict(self.stats[name], size=lane.get('size'), max_waiting=lane.get('max_waiting'))
+                for name, lane in self.lanes.items()}
+
+
+def select_fired(selectors, triggers, payload):
+    # A trigger whose stored selector can not be compiled or evaluated is skipped instead of failing the others
+    fired = []
+    for t in triggers:
+        try:
+            if selectors.compile(t.get('selector'))(payload):
+                fired.append(t)
+        except (MetadataServiceError, TypeError) as exc:
+            _logger.warning('Skipping trigger {} with a bad selector: {}'.format(t.get('id'), exc))
+    return fired
+
+
+def split_changes(changes, seq, grace):
+    # Sequences are taken before the changes are written, so a missing one may still be in flight. Changes are
+    # only handed out up to the first missing sequence, which is given up as lost once the change following it
+    # is older than the grace period
+    contiguous = []
+    for c in changes:
+        if c['seq'] != seq + len(contiguous) + 1:
+            age = datetime.datetime.utcnow() - c['date']
+            return contiguous, age.total_seconds() > grace
+        contiguous.append(c)
+    return contiguous, False
+
+
+class SelectorCache(DependencyProvider):
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.compiled = {}
+
+    def get_dependency(self, worker_ctx):
+        return self
+
+    def compile(self, selector):
+        key = bson.json_util.dumps(selector, sort_keys=True)
+
+        predicate = self.compiled.get(key)
+        if predicate is None:
+            if len(self.compiled) >= self.max_size:
+                self.compiled.clear()
+            predicate = self.compiled[key] = compile_selector(selector)
+
+        return predicate
+
+
+class WarmUp(DependencyProvider):
+
+    def __init__(self, max_users=1000):
+        self.max_users = max_users
+        self.ready = False
+        self.report = {}
+
+    def setup(self):
+        self.max_users = self.container.config.get('WARM_UP_MAX_USERS', self.max_users)
+
+    def start(self):
+        database = next(d for d in self.container.dependencies if isinstance(d, MongoDatabase))
+        selectors = next(d for d in self.container.dependencies if isinstance(d, SelectorCache))
+        read_database = getattr(database, 'read_database', None)
+        self.container.spawn_managed_thread(lambda: self.warm(database.db, selectors, read_database=read_database),
+                                            identifier='warm_up')
+
+    def get_dependency(self, worker_ctx):
+        return self
+
+    @staticmethod
+    def _memory():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def warm(self, database, selectors, read_database=None):
+        # Loads the hot read paths into the Mongo cache and compiles the trigger selectors before reporting ready,
+        # a failure is only reported since the service can still serve cold. Templates and triggers are read where
+        # their RPCs read, transformations from the primary like the pipelines
+        if read_database is None:
+            read_database = database
+
+        start = time.monotonic()
+        memory = self._memory()
+        documents = {}
+        report = {}
+
+        try:
+            documents['templates'] = 0
+            for user in read_database.templates.distinct('allowed_users')[:self.max_users]:
+                documents['templates'] += len(list(read_database.templates.find(
+                    {'allowed_users': user}, {'_id': 0, 'svg': 0, 'queries': 0, 'allowed_users': 0})
+                                                   .sort('id', ASCENDING)))
+
+            documents['triggers'] = 0
+            for trigger in read_database.triggers.find({}, {'_id': 0, 'id': 1, 'selector': 1}):
+                try:
+                    selectors.compile(trigger.get('selector'))
+                except MetadataServiceError as exc:
+                    _logger.warning('Could not compile selector of trigger {}: {}'.format(trigger['id'], exc))
+                documents['triggers'] += 1
+
+            documents['transformations'] = len(list(database.transformations.find(
+                {}, {'_id': 0, 'id': 1, 'job_id': 1, 'depends_on': 1, 'trigger_tables': 1, 'target_table': 1,
+                     'process_date': 1})))
+        except Exception as exc:
+            _logger.warning('Warm-up failed: {}'.format(exc))
+            report['error'] = str(exc)
+
+        report.update(duration=time.monotonic() - start, documents=documents,
+                      memory={'before': memory, 'after': self._memory()})
+        self.report = report
+        self.ready = True
+
+        _logger.info('Warm-up completed in {:.2f}s: {}'.format(report['duration'], documents))
+
+    def get_report(self):
+        return dict(self.report, ready=self.ready)
+
+
+class ArchivePolicy(DependencyProvider):
+    # after_days applies to unreferenced functions, queries and triggers. Transformations which have not been
+    # processed for transformations_after_days are only archived when it is set
+
+    def __init__(self, after_days=90, transformations_after_days=None, batch_size=500):
+        self.after_days = after_days
+        self.transformations_after_days = transformations_after_days
+        self.batch_size = batch_size
+
+    def setup(self):
+        self.after_days = self.container.config.get('ARCHIVE_AFTER_DAYS', self.after_days)
+        self.transformations_after_days = self.container.config.get('ARCHIVE_TRANSFORMATIONS_AFTER_DAYS',
+                                                                    self.transformations_after_days)
+        self.batch_size = self.container.config.get('ARCHIVE_BATCH_SIZE', self.batch_size)
+
+    def get_dependency(self, worker_ctx):
+        return self
+
+    @staticmethod
+    def _cutoff(days):
+        if days is None:
+            return None
+        return datetime.datetime.utcnow() - datetime.timedelta(days=days)
+
+    def cutoff(self):
+        return self._cutoff(self.after_days)
+
+    def transformations_cutoff(self):
+        return self._cutoff(self.transformations_after_days)
+
+
+class PipelineDebouncer(DependencyProvider):
+    # Pending pipelines are stored in the pending_pipelines collection so that they survive restarts and are
+    # shared by every instance, only the table to jobs lookups are cached in memory
+
+    def __init__(self, window=5):
+        self.window = window
+        self.lookups = {}
+
+    def setup(self):
+        self.window = self.container.config.get('PIPELINE_DEBOUNCE_WINDOW', self.window)
+
+    def get_dependency(self, worker_ctx):
+        return self
+
+    def get_jobs(self, table):
+        lookup = self.lookups.get(table)
+        if lookup is not None and lookup[1] > time.monotonic():
+            return lookup[0]
+        return None
+
+    def add(self, table, job_ids):
+        self.lookups[table] = (job_ids, time.monotonic() + self.window)
+
+    def prune(self):
+        now = time.monotonic()
+        for table in [table for table, lookup in self.lookups.items() if lookup[1] <= now]:
+            del self.lookups[table]
+
+
+STATS_HISTORY = 20
+
+
+def _write_table_dates(database, dates):
+    if len(dates) == 0:
+        return
+
+    database.tables.create_index('table', unique=True)
+
+    database.tables.bulk_write([
+        UpdateOne({'table': table}, {'$max': {'update_date': update_date}}, upsert=True)
+        for table, update_date in dates.items()
+    ])
+
+
+def _log_changes(database, collection, ids, op, fields=None):
+    # Appends the changes to the change log and returns them without their date for dispatching
+    if len(ids) == 0:
+        return []
+
+    counter = database.counters.find_one_and_update(
+        {'_id': 'changes'}, {'$inc': {'seq': len(ids)}}, upsert=True, return_document=ReturnDocument.AFTER)
+    first = counter['seq'] - len(ids) + 1
+
+    changes = [{'seq': first + i, 'collection': collection, 'id': _id, 'op': op, 'fields': fields}
+               for i, _id in enumerate(ids)]
+
+    date = datetime.datetime.utcnow()
+    database.changes.insert_many([dict(c, date=date) for c in changes])
+
+    return changes
+
+
+def _write_process_records(database, records):
+    # Returns the changes of the transformations which have been found
+    operations = []
+    for r in records:
+        update = {'$max': {'process_date': r['finished_at']}}
+        if r['duration'] is not None:
+            update['$push'] = {
+                'stats': {
+                    '$each': [{'date': r['finished_at'], 'duration': r['duration'], 'rows': r['rows']}],
+                    '$slice': -STATS_HISTORY
+                }
+            }
+        operations.append(UpdateOne({'id': r['id']}, update))
+
+    if len(operations) == 0:
+        return []
+
+    database.transformations.bulk_write(operations, ordered=False)
+
+    ids = list(dict.fromkeys(r['id'] for r in records))
+    targets = {t['id']: t.get('target_table') for t in database.transformations.find(
+        {'id': {'$in': ids}}, {'_id': 0, 'id': 1, 'target_table': 1})}
+
+    dates = {}
+    for r in records:
+        table = targets.get(r['id'])
+        if table is not None:
+            dates[table] = max(dates.get(table, r['finished_at']), r['finished_at'])
+    _write_table_dates(database, dates)
+
+    return _log_changes(database, 'transformations', [i for i in ids if i in targets], 'update',
+                        fields=['process_date', 'stats'])
+
+
+class ProcessDateBuffer(DependencyProvider):
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.records = []
+
+    def setup(self):
+        self.max_size = self.container.config.get('PROCESS_DATE_BUFFER_SIZE', self.max_size)
+
+    def stop(self):
+        records = self.drain()
+        if len(records) == 0:
+            return
+
+        # Dependencies are stopped concurrently and pymongo reopens a closed client on use, so the client is
+        # closed again once the remaining records are written
+        database = next(d for d in self.container.dependencies if isinstance(d, MongoDatabase)).database
+        _logger.info('Flushing {} buffered process dates before stopping'.format(len(records)))
+        try:
+            _write_process_records(database, records)
+        finally:
+            database.client.close()
+
+    def get_dependency(self, worker_ctx):
+        return self
+
+    def add(self, records):
+        self.records.extend(records)
+        return len(self.records) >= self.max_size
+
+    def drain(self):
+        records, self.records = self.records, []
+        return records
+
+
+class RoutedMongoDatabase(MongoDatabase):
+
+    READ_PREFERENCES = {
+        'primaryPreferred': PrimaryPreferred,
+        'secondary': Secondary,
+        'secondaryPreferred': SecondaryPreferred,
+        'nearest': Nearest
+    }
+
+    def __init__(self, primary_reads=(), **kwargs):
+        super(RoutedMongoDatabase, self).__init__(**kwargs)
+        self.primary_reads = set(primary_reads)
+        self.read_database = None
+
+    def setup(self):
+        super(RoutedMongoDatabase, self).setup()
+
+        mode = self.container.config.get('MONGODB_READ_PREFERENCE', 'primary')
+        if mode == 'primary':
+            self.read_database = self.database
+            return
+
+        if mode not in self.READ_PREFERENCES:
+            raise MetadataServiceError('Unavailable read preference {}'.format(mode))
+
+        max_staleness = self.container.config.get('MONGODB_MAX_STALENESS', -1)
+        self.read_database = self.database.with_options(
+            read_preference=self.READ_PREFERENCES[mode](max_staleness=max_staleness))
+
+    def stop(self):
+        super(RoutedMongoDatabase, self).stop()
+        self.read_database = None
+
+    def get_dependency(self, worker_ctx):
+        # Only read RPCs which tolerate replication lag are sent to the configured read preference
+        method_name = worker_ctx.entrypoint.method_name
+        if isinstance(worker_ctx.entrypoint, Rpc) and method_name.startswith('get_') \
+                and method_name not in self.primary_reads:
+            return self.read_database
+        return self.db
+
+
 class MetadataService(object):
     name = 'metadata'
     error = ErrorHandler()
-    database = MongoDatabase(result_backend=False)
+    database = RoutedMongoDatabase(result_backend=False, primary_reads=(
+        'get_update_pipeline', 'get_stale_pipeline', 'get_functions', 'get_changes_since'),
+        on_after_setup=lambda provider: MetadataService._ensure_change_log(provider.db))
+    selectors = SelectorCache()
+    pipeline_debouncer = PipelineDebouncer()
+    process_date_buffer = ProcessDateBuffer()
+    worker_lanes = WorkerLanes()
+    warm_up = WarmUp()
+    archive_policy = ArchivePolicy()
+    dispatch = EventDispatcher()
 
     TYPES = ['transform', 'predict', 'fit']
 
+    CHANGE_LOG_SIZE = 16 * 1024 * 1024
+    CHANGE_LOG_MAX = 100000
+    CHANGE_GAP_GRACE = 10
+
+    COMPRESSION_THRESHOLD = 4096
+    COMPRESSED_SUBTYPE = 128
+    COMPRESSED_FIELDS = {
+        'functions': ('function',),
+        'queries': ('sql',),
+        'templates': ('svg', 'html')
+    }
+
+    @classmethod
+    def _ensure_change_log(cls, database):
+        try:
+            database.create_collection('changes', capped=True, size=cls.CHANGE_LOG_SIZE, max=cls.CHANGE_LOG_MAX)
+        except CollectionInvalid:
+            return
+        database.changes.create_index('seq')
+
+    def _record_changes(self, collection, ids, op, fields=None):
+        for c in _log_changes(self.database, collection, ids, op, fields=fields):
+            self.dispatch('metadata_change', c)
+
+    def _record_change(self, collection, _id, op, fields=None):
+        self._record_changes(collection, [_id], op, fields=fields)
+
+    @staticmethod
+    def _content_hash(content):
+        return hashlib.sha256(bson.json_util.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _compress(self, value):
+        if not isinstance(value, str):
+            return value
+
+        data = value.encode('utf-8')
+        if len(data) < self.COMPRESSION_THRESHOLD:
+            return value
+
+        return Binary(zlib.compress(data), self.COMPRESSED_SUBTYPE)
+
+    @classmethod
+    def _inflate(cls, collection, docs):
+        # Compressed fields are only decompressed when the projection of the read kept them
+        fields = cls.COMPRESSED_FIELDS.get(collection, ())
+        for doc in docs:
+            if doc is None:
+                continue
+            for f in fields:
+                value = doc.get(f)
+                if isinstance(value, Binary) and value.subtype == cls.COMPRESSED_SUBTYPE:
+                    doc[f] = zlib.decompress(value).decode('utf-8')
+
+        return docs
+
+    def _upsert(self, collection, _id, content, reset=None, unset=None):
+        content_hash = self._content_hash(content)
+
+        current = self.database[collection].find_one({'id': _id}, {'_id': 0, 'content_hash': 1})
+        if current is not None and current.get('content_hash') == content_hash:
+            return False
+
+        doc = dict(content, content_hash=content_hash, creation_date=datetime.datetime.utcnow(), **(reset or {}))
+        for f in self.COMPRESSED_FIELDS.get(collection, ()):
+            if f in doc:
+                doc[f] = self._compress(doc[f])
+        update = {'$set': doc}
+        if unset:
+            update['$unset'] = {f: '' for f in unset}
+        self.database[collection].update_one({'id': _id}, update, upsert=True)
+        self._record_change(collection, _id, 'upsert', fields=list(doc))
+
+        return True
+
     def _delete_outdated_subscriptions(self, user, meta_type, new_sub, old_sub):
         old = set()
         if 'subscription' in old_sub and meta_type in old_sub['subscription']:
@@ -47,6 +643,7 @@ class MetadataService(object):
             {'id': {'$in': list(diff)}},
             {'$pull': {'allowed_users': user}}
         )
+        self._record_changes(meta_type, sorted(diff), 'update', fields=['allowed_users'])
 
     def _add_subscriptions(self, user, meta_type, sub):
         if meta_type in sub:
@@ -54,8 +651,10 @@ class MetadataService(object):
                 {'id': {'$in': sub[meta_type]}},
                 {'$addToSet': {'allowed_users': user}}
             )
+            self._record_changes(meta_type, list(sub[meta_type]), 'update', fields=['allowed_users'])
 
     @event_handler('subscription_manager', 'user_sub')
+    @in_lane('background')
     def handle_suscription(self, payload):
         user = payload['user']
         _logger.info('Receiving subscription for user {}'.format(user))
@@ -72,9 +671,12 @@ class MetadataService(object):
                 self._add_subscriptions(user, t, metadata)
             self.database.subscriptions.update_one({'user': user},
                                                    {'$set': {'subscription': metadata}}, upsert=True)
+            self._record_change('subscriptions', user, 'upsert', fields=['subscription'])
 
     @staticmethod
     def _check_function(_function):
+        import sqlparse
+
         sqls = sqlparse.parse(_function)
 
         if len(sqls) != 1:
@@ -93,6 +695,8 @@ class MetadataService(object):
 
     @staticmethod
     def _check_query(query):
+        import sqlparse
+
         sqls = sqlparse.parse(query)
 
         if len(sqls) != 1:
@@ -103,6 +707,56 @@ class MetadataService(object):
 
         return True
 
+    @staticmethod
+    def _extract_tables(query):
+        import sqlparse
+
+        tables = []
+        ctes = set()
+
+        def visit(token_list):
+            expect_table = False
+            expect_cte = False
+            for token in token_list.tokens:
+                if token.is_whitespace or token.ttype in sqlparse.tokens.Comment:
+                    continue
+
+                if token.ttype is sqlparse.tokens.CTE:
+                    expect_cte = True
+                    continue
+
+                # Non reserved words such as SOURCE or FIRST are lexed as keywords even when they name a table
+                if token.is_keyword and not (expect_table and token.ttype is sqlparse.tokens.Keyword
+                                             and token.normalized != 'FROM' and not token.normalized.endswith('JOIN')):
+                    expect_table = token.normalized == 'FROM' or token.normalized.endswith('JOIN')
+                    continue
+
+                if expect_cte or expect_table:
+                    items = token.get_identifiers() if isinstance(token, sqlparse.sql.IdentifierList) else [token]
+                    for item in items:
+                        if expect_cte and isinstance(item, sqlparse.sql.Identifier):
+                            ctes.add(item.get_name())
+                            visit(item)
+                        elif item.ttype is sqlparse.tokens.Keyword:
+                            tables.append(item.value)
+                        elif isinstance(item, sqlparse.sql.Identifier) and not any(
+                                isinstance(t, (sqlparse.sql.Parenthesis, sqlparse.sql.Function)) for t in item.tokens):
+                            parent = item.get_parent_name()
+                            name = item.get_real_name()
+                            tables.append('{}.{}'.format(parent, name) if parent else name)
+                        elif item.is_group:
+                            visit(item)
+                    expect_table = expect_cte = False
+                    continue
+
+                if token.is_group:
+                    visit(token)
+
+        for statement in sqlparse.parse(query):
+            visit(statement)
+
+        return [t for t in dict.fromkeys(tables) if t not in ctes]
+
     @staticmethod
     def _extract_function_name(_function):
         regex = re.search(r'CREATE (FUNCTION|AGGREGATE) ([A-Za-z_]+)', _function)
@@ -116,9 +770,95 @@ class MetadataService(object):
     def _build_output(_input, function_name):
         return 'SELECT * FROM {}(({}))'.format(function_name, _input)
 
+    def _lookup_ids(self, collection, ids, query=None, key='id'):
+        ids = list(dict.fromkeys(ids))
+
+        criteria = {key: {'$in': ids}}
+        if query is not None:
+            criteria.update(query)
+
+        found = {doc[key]: doc for doc in self._inflate(collection.name, list(collection.find(criteria, {'_id': 0})))}
+
+        return {
+            'results': [found[i] for i in ids if i in found],
+            'missing': [i for i in ids if i not in found]
+        }
+
+    def _find_by_ids(self, collection, ids, query=None):
+        return bson.json_util.dumps(self._lookup_ids(collection, ids, query=query))
+
+    def _store_function(self, function_name, _function):
+        function_hash = hashlib.sha256(_function.encode('utf-8')).hexdigest()
+
+        self.database.functions.create_index('hash', unique=True)
+        result = self.database.functions.update_one({'hash': function_hash}, {
+            '$setOnInsert': {
+                'hash': function_hash,
+                'function_name': function_name,
+                'function': self._compress(_function),
+                'creation_date': datetime.datetime.utcnow()
+            }
+        }, upsert=True)
+
+        if result.upserted_id is not None:
+            self._record_change('functions', function_hash, 'insert')
+
+        return function_hash
+
+    def _resolve_functions(self, transformations):
+        # Transformations only keep the hash of their function, legacy ones still hold the function text
+        hashes = list(set(t['function_hash'] for t in transformations
+                          if t.get('function_hash') is not None and 'function' not in t))
+        if len(hashes) == 0:
+            return transformations
+
+        functions = {f['hash']: f['function'] for f in self._inflate('functions', list(self.database.functions.find(
+            {'hash': {'$in': hashes}}, {'_id': 0, 'hash': 1, 'function': 1})))}
+
+        for t in transformations:
+            if 'function' not in t and t.get('function_hash') in functions:
+                t['function'] = functions[t['function_hash']]
+
+        return transformations
+
+    def _check_dependencies(self, _id, job_id, depends_on):
+        if _id in depends_on:
+            raise MetadataServiceError('Transformation {} can not depend on itself'.format(_id))
+
+        cursor = self.database.transformations.aggregate([
+            {
+                '$match': {'id': {'$in': depends_on}, 'job_id': job_id}
+            },
+            {
+                '$graphLookup': {
+                    'from': 'transformations',
+                    'startWith': '$depends_on',
+                    'connectFromField': 'depends_on',
+                    'connectToField': 'id',
+                    'as': 'ancestors',
+                    'restrictSearchWithMatch': {'job_id': job_id}
+                }
+            },
+            {
+                '$project': {'_id': 0, 'id': 1, 'ancestors': '$ancestors.id'}
+            }
+        ])
+
+        found = set()
+        for dependency in cursor:
+            found.add(dependency['id'])
+            if _id in dependency['ancestors']:
+                raise MetadataServiceError(
+                    'Dependency {} of transformation {} would create a cycle'.format(dependency['id'], _id))
+
+        for dependency in depends_on:
+            if dependency not in found:
+                raise MetadataServiceError(
+                    'Unknown dependency {} for job_id {}'.format(dependency, job_id))
+
     @rpc
     def add_transformation(self, _id, _type, _function, job_id, _input=None, target_table=None, trigger_tables=None,
-                           depends_on=None, parameters=None):
+                           depends_on=None, parameters=None, infer_trigger_tables=True):
         self.database.transformations.create_index('trigger_tables')
         self.database.transformations.create_index('id', unique=True)
 
@@ -143,41 +883,48 @@ class MetadataService(object):
             raise MetadataServiceError(
                 'Bad formatted query: {}'.format(_input))
 
+        input_tables = None
+        if _input is not None:
+            input_tables = self._extract_tables(_input)
+
+            # Supplied trigger tables are added to the input tables unless inference is explicitly turned off
+            if trigger_tables is None:
+                trigger_tables = input_tables
+            elif infer_trigger_tables is True:
+                trigger_tables = input_tables + [t for t in trigger_tables if t not in input_tables]
+
         # if self._check_function(_function) is False:
         #     raise MetadataServiceError('Bad formatted function: {}'.format(_function))
 
-        if depends_on is not None \
-                and self.database.transformations.find_one({'id': depends_on, 'job_id': job_id}) is None:
-            raise MetadataServiceError(
-                'Unknown dependency {} for job_id {}'.format(depends_on, job_id))
+        if depends_on is not None:
+            if not isinstance(depends_on, list):
+                depends_on = [depends_on]
+            self._check_dependencies(_id, job_id, depends_on)
 
         output = None
         if materialized is True:
             output = self._build_output(_input, function_name)
 
-        self.database.transformations.update_one(
-            {'id': _id},
-            {
-                '$set': {
-                    'type': _type,
-                    'function': _function,
-                    'job_id': job_id,
-                    'input': _input,
-                    'parameters': parameters,
-                    'output': output,
-                    'target_table': target_table,
-                    'trigger_tables': trigger_tables,
-                    'depends_on': depends_on,
-                    'materialized': materialized,
-                    'function_only': function_only,
-                    'function_name': function_name,
-                    'creation_date': datetime.datetime.utcnow(),
-                    'process_date': None
-                }
-            }, upsert=True
-        )
-
-        return {'id': _id}
+        function_hash = self._store_function(function_name, _function)
+
+        doc = {
+            'type': _type,
+            'function_hash': function_hash,
+            'job_id': job_id,
+            'input': _input,
+            'parameters': parameters,
+            'output': output,
+            'target_table': target_table,
+            'input_tables': input_tables,
+            'trigger_tables': trigger_tables,
+            'depends_on': depends_on,
+            'materialized': materialized,
+            'function_only': function_only,
+            'function_name': function_name
+        }
+        changed = self._upsert('transformations', _id, doc, reset={'process_date': None}, unset=['function'])
+
+        return {'id': _id, 'changed': changed}
 
     @rpc
     def delete_transformation(self, _id):
@@ -185,19 +932,136 @@ class MetadataService(object):
             raise MetadataServiceError(
                 'At least one transformation depends on {}'.format(_id))
 
-        self.database.transformations.delete_one({'id': _id})
+        if self.database.transformations.delete_one({'id': _id}).deleted_count != 0:
+            self._record_change('transformations', _id, 'delete')
 
         return {'id': _id}
 
+    def _plan_transformation_deletes(self, ids, cascade=False):
+        # Reverse dependencies of the whole catalog are resolved in one pass, the plan deletes dependents before
+        # the transformations they depend on
+        dependents = {}
+        known = set()
+        for t in self.database.transformations.find({}, {'_id': 0, 'id': 1, 'depends_on': 1}):
+            known.add(t['id'])
+            for dependency in get_dependencies(t):
+                dependents.setdefault(dependency, []).append(t['id'])
+
+        closure = set(i for i in ids if i in known)
+        pending = list(closure)
+        blocking = {}
+        while pending:
+            _id = pending.pop()
+            for child in dependents.get(_id, []):
+                if child in closure:
+                    continue
+                if cascade is not True:
+                    blocking.setdefault(child, []).append(_id)
+                    continue
+                closure.add(child)
+                pending.append(child)
+
+        if len(blocking) != 0:
+            raise MetadataServiceError('Transformations {} depend on deleted transformations'
+                                       .format(sorted(blocking)))
+
+        order = []
+        visited = set()
+
+        def visit(_id):
+            if _id not in visited:
+                visited.add(_id)
+                for child in sorted(dependents.get(_id, [])):
+                    if child in closure:
+                        visit(child)
+                order.append(_id)
+
+        for _id in sorted(closure):
+            visit(_id)
+
+        return order
+
+    @rpc
+    def delete_transformations(self, ids, cascade=False):
+        order = self._plan_transformation_deletes(ids, cascade=cascade)
+
+        if len(order) != 0:
+            self.database.transformations.bulk_write([DeleteOne({'id': _id}) for _id in order], ordered=True)
+            self._record_changes('transformations', order, 'delete')
+
+        return {'deleted': {'transformations': order}}
+
+    @rpc
+    def delete_job(self, job_id, cascade=False):
+        ids = [t['id'] for t in self.database.transformations.find({'job_id': job_id}, {'_id': 0, 'id': 1})]
+
+        return self.delete_transformations(ids, cascade=cascade)
+
+    @staticmethod
+    def _parse_process_record(record):
+        if not isinstance(record, dict):
+            record = dict(zip(('id', 'finished_at', 'duration', 'rows'), record))
+
+        if 'id' not in record:
+            raise MetadataServiceError('ID not found in process record')
+
+        finished_at = record.get('finished_at')
+        if finished_at is None:
+            finished_at = datetime.datetime.utcnow()
+        elif not isinstance(finished_at, datetime.datetime):
+            import dateutil.parser
+            finished_at = dateutil.parser.parse(finished_at)
+
+        if finished_at.tzinfo is not None:
+            finished_at = finished_at.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+        return {'id': record['id'], 'finished_at': finished_at, 'duration': record.get('duration'),
+                'rows': record.get('rows')}
+
+    def _apply_process_records(self, records):
+        changes = _write_process_records(self.database, records)
+
+        for c in changes:
+            self.dispatch('metadata_change', c)
+
+        return len(changes)
+
     @rpc
-    def update_process_date(self, _id):
-        self.database.transformations.update_one(
-            {'id': _id}, {'$set': {'process_date': datetime.datetime.utcnow()}})
+    def update_process_date(self, _id, duration=None, rows=None):
+        self._apply_process_records([self._parse_process_record({'id': _id, 'duration': duration, 'rows': rows})])
+
+    @rpc
+    @in_lane('write')
+    def update_process_dates(self, records, write_behind=False):
+        records = [self._parse_process_record(r) for r in records]
+
+        if write_behind is True:
+            if self.process_date_buffer.add(records):
+                self.flush_process_dates()
+            return {'buffered': len(records)}
+
+        return {'updated': self._apply_process_records(records)}
+
+    @timer(interval=5)
+    def flush_process_dates(self):
+        records = self.process_date_buffer.drain()
+
+        if len(records) != 0:
+            _logger.info('Flushing {} buffered process dates'.format(len(records)))
+            self._apply_process_records(records)
 
     @rpc
     def get_types(self):
         return self.TYPES
 
+    @rpc
+    def get_lane_stats(self):
+        return self.worker_lanes.get_stats()
+
+    @rpc
+    def get_readiness(self):
+        return self.warm_up.get_report()
+
     @rpc
     def get_all_transformations(self):
         cursor = self.database.transformations.find({}, {'_id': 0, 'input': 0, 'function': 0, 'output': 0, 'parameters': 0,
@@ -207,78 +1071,197 @@ class MetadataService(object):
 
     @rpc
     def get_transformation(self, _id):
-        return bson.json_util.dumps(self.database.transformations.find_one({'id': _id}, {'_id': 0}))
+        transformation = self.database.transformations.find_one({'id': _id}, {'_id': 0})
+
+        if transformation is not None:
+            self._resolve_functions([transformation])
+
+        return bson.json_util.dumps(transformation)
 
     @rpc
-    def get_update_pipeline(self, table):
-        cursor = self.database.transformations.aggregate([
+    def get_transformations(self, ids):
+        found = self._lookup_ids(self.database.transformations, ids)
+        self._resolve_functions(found['results'])
+
+        return bson.json_util.dumps(found)
+
+    @rpc
+    def get_functions(self, hashes):
+        return bson.json_util.dumps(self._lookup_ids(self.database.functions, hashes, key='hash'))
+
+    @staticmethod
+    def _build_triggered_stages(tables, job_id):
+        # Downstream transformations are only followed within the job of the triggered ones since the upstream of
+        # a pipeline entry is planned within its job. A transformation of another job reading one of their target
+        # tables is left to a notification of that table
+        return [
             {
                 '$match': {
-                    'trigger_tables': table
+                    'trigger_tables': {'$in': tables},
+                    'job_id': job_id
                 }
             },
             {
                 '$graphLookup': {
                     'from': 'transformations',
-                    'startWith': '$depends_on',
-                    'connectFromField': 'depends_on',
-                    'connectToField': 'id',
-                    'as': 'dependencies'
+                    'startWith': '$target_table',
+                    'connectFromField': 'target_table',
+                    'connectToField': 'trigger_tables',
+                    'as': 'downstream',
+                    'restrictSearchWithMatch': {'trigger_tables': {'$ne': None}, 'job_id': job_id}
                 }
             },
             {
-                '$group': {
-                    '_id': '$job_id',
-                    'transformations': {
-                        '$addToSet': {
-                            'id': '$id',
-                            'materialized': '$materialized',
-                            'function_name': '$function_name',
-                            'function': '$function',
-                            'target_table': '$target_table',
-                            'function_only': '$function_only',
-                            'type': '$type',
-                            'input': '$input',
-                            'output': '$output',
-                            'parameters': '$parameters',
-                            'process_date': '$process_date',
-                            'index': {'$size': '$dependencies'},
-                            'dependencies': '$dependencies'
-                        }
-                    }
+                '$project': {
+                    'transformations': {'$concatArrays': [['$$ROOT'], '$downstream']}
                 }
             },
             {
                 '$unwind': '$transformations'
             },
-            {
-                '$sort': {'transformations.index': 1}
-            },
             {
                 '$group': {
-                    '_id': '$_id',
-                    'transformations': {
-                        '$push': {
-                            'transformations': '$transformations'
-                        }
-                    }
+                    '_id': '$transformations.id',
+                    'transformation': {'$first': '$transformations'}
                 }
             },
             {
-                '$project': {
-                    'job_id': '$_id',
-                    'transformations': '$transformations.transformations'
+                '$replaceRoot': {'newRoot': '$transformation'}
+            }
+        ]
+
+    def _find_pipeline_jobs(self, tables):
+        return sorted(self.database.transformations.distinct('job_id', {'trigger_tables': {'$in': tables}}))
+
+    def _aggregate_triggered(self, tables, stages):
+        transformations = []
+        for job_id in self._find_pipeline_jobs(tables):
+            transformations += list(self.database.transformations.aggregate(
+                self._build_triggered_stages(tables, job_id) + stages))
+        return transformations
+
+    def _find_pipeline_transformations(self, tables, lean=False):
+        if lean is True:
+            return self._find_lean_pipeline_transformations(tables)
+
+        return self._aggregate_triggered(tables, [
+            {
+                '$graphLookup': {
+                    'from': 'transformations',
+                    'startWith': '$depends_on',
+                    'connectFromField': 'depends_on',
+                    'connectToField': 'id',
+                    'as': 'dependencies'
                 }
+            },
+            {
+                '$project': {'downstream': 0}
+            }
+        ])
+
+    def _find_lean_pipeline_transformations(self, tables):
+        # Dependencies are resolved from an id only skeleton of the jobs instead of embedding full copies of the
+        # ancestors, which makes the payload grow quadratically with the depth of the chains
+        transformations = self._aggregate_triggered(tables, [
+            {
+                '$project': {'downstream': 0}
             }
         ])
 
-        result = list(cursor)
+        skeleton = list(self.database.transformations.find(
+            {'job_id': {'$in': list(set(t['job_id'] for t in transformations))}},
+            {'_id': 0, 'id': 1, 'depends_on': 1, 'process_date': 1}))
+
+        by_id = {t['id']: t for t in skeleton}
+        ancestors = get_ancestors(skeleton)
+        for t in transformations:
+            t['dependencies'] = [by_id[a] for a in ancestors.get(t['id'], [])]
+
+        return transformations
+
+    @rpc
+    @single_flight
+    @in_lane('heavy')
+    def get_update_pipeline(self, table, lean=False):
+        result = build_pipeline(self._find_pipeline_transformations([table], lean=lean), lean=lean)
 
         if len(result) != 0:
             return bson.json_util.dumps(result)
 
         return None
 
+    @rpc
+    @single_flight
+    @in_lane('heavy')
+    def get_stale_pipeline(self, table, lean=False):
+        transformations = self._find_pipeline_transformations([table], lean=lean)
+
+        tables = set(table for t in transformations for table in t.get('trigger_tables') or [])
+        table_dates = {t['table']: t['update_date'] for t in self.database.tables.find(
+            {'table': {'$in': list(tables)}}, {'_id': 0, 'table': 1, 'update_date': 1})}
+
+        result = build_pipeline(find_stale(transformations, table_dates), lean=lean)
+
+        if len(result) != 0:
+            return bson.json_util.dumps(result)
+
+        return None
+
+    @rpc
+    def update_table_date(self, table):
+        _write_table_dates(self.database, {table: datetime.datetime.utcnow()})
+
+    @rpc
+    @in_lane('write')
+    def notify_table_update(self, table):
+        _write_table_dates(self.database, {table: datetime.datetime.utcnow()})
+
+        job_ids = self.pipeline_debouncer.get_jobs(table)
+        if job_ids is None:
+            job_ids = self._find_pipeline_jobs([table])
+
+        self.pipeline_debouncer.add(table, job_ids)
+        self._schedule_pipelines(table, job_ids)
+
+        return {'table': table, 'job_ids': job_ids}
+
+    def _schedule_pipelines(self, table, job_ids):
+        if len(job_ids) == 0:
+            return
+
+        self.database.pending_pipelines.create_index('job_id', unique=True)
+
+        # The deadline is only set by the first notification so that a job is not postponed forever
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.pipeline_debouncer.window)
+        self.database.pending_pipelines.bulk_write([
+            UpdateOne({'job_id': job_id}, {'$addToSet': {'tables': table}, '$setOnInsert': {'deadline': deadline}},
+                      upsert=True)
+            for job_id in job_ids
+        ])
+
+    def _claim_due_pipelines(self):
+        now = datetime.datetime.utcnow()
+        while True:
+            pending = self.database.pending_pipelines.find_one_and_delete({'deadline': {'$lte': now}})
+            if pending is None:
+                return
+            yield pending['job_id'], set(pending['tables'])
+
+    @timer(interval=1)
+    def flush_pipelines(self):
+        self.pipeline_debouncer.prune()
+
+        for job_id, tables in self._claim_due_pipelines():
+            transformations = [t for t in self._find_pipeline_transformations(sorted(tables)) if t['job_id'] == job_id]
+
+            for pipeline in build_pipeline(transformations):
+                _logger.info('Dispatching pipeline of job {} for tables {}'.format(job_id, sorted(tables)))
+                self.dispatch('job_pipeline', {
+                    'job_id': job_id,
+                    'tables': sorted(tables),
+                    'pipeline': bson.json_util.dumps(pipeline)
+                })
+
     @rpc
     def add_query(self, _id, name, sql, parameters=None):
         self.database.queries.create_index('id', unique=True)
@@ -287,16 +1270,14 @@ class MetadataService(object):
             raise MetadataServiceError(
                 'An error occured while parsing SQL query: {}'.format(sql))
 
-        self.database.queries.update_one({'id': _id}, {
-            '$set': {
-                'name': name,
-                'sql': sql,
-                'parameters': parameters,
-                'creation_date': datetime.datetime.utcnow()
-            }
-        }, upsert=True)
+        doc = {
+            'name': name,
+            'sql': sql,
+            'parameters': parameters
+        }
+        changed = self._upsert('queries', _id, doc)
 
-        return {'id': _id}
+        return {'id': _id, 'changed': changed}
 
     @rpc
     def delete_query(self, _id):
@@ -306,10 +1287,32 @@ class MetadataService(object):
             raise MetadataServiceError(
                 'Template {} depends on query {}. Cannot delete it'.format(t['id'], _id))
 
-        self.database.queries.delete_one({'id': _id})
+        if self.database.queries.delete_one({'id': _id}).deleted_count != 0:
+            self._record_change('queries', _id, 'delete')
 
         return {'id': _id}
 
+    @rpc
+    def delete_queries(self, ids, cascade=False):
+        ids = list(dict.fromkeys(ids))
+        templates = [t['id'] for t in self.database.templates.find({'queries.id': {'$in': ids}}, {'_id': 0, 'id': 1})]
+
+        if len(templates) != 0:
+            if cascade is not True:
+                raise MetadataServiceError('Templates {} depend on deleted queries'.format(sorted(templates)))
+
+            self.database.templates.bulk_write([
+                UpdateMany({'id': {'$in': templates}}, {'$pull': {'queries': {'id': {'$in': ids}}}})
+            ])
+            self._record_changes('templates', sorted(templates), 'update', fields=['queries'])
+
+        deleted = sorted(q['id'] for q in self.database.queries.find({'id': {'$in': ids}}, {'_id': 0, 'id': 1}))
+        if len(deleted) != 0:
+            self.database.queries.bulk_write([DeleteMany({'id': {'$in': deleted}})])
+            self._record_changes('queries', deleted, 'delete')
+
+        return {'deleted': {'queries': deleted}, 'updated': {'templates': sorted(templates)}}
+
     @rpc
     def get_all_queries(self):
         cursor = self.database.queries.find(
@@ -319,7 +1322,13 @@ class MetadataService(object):
 
     @rpc
     def get_query(self, _id):
-        return bson.json_util.dumps(self.database.queries.find_one({'id': _id}, {'_id': 0}))
+        query = self.database.queries.find_one({'id': _id}, {'_id': 0})
+
+        return bson.json_util.dumps(self._inflate('queries', [query])[0])
+
+    @rpc
+    def get_queries(self, ids):
+        return self._find_by_ids(self.database.queries, ids)
 
     @rpc
     def add_template(self, _id, name, language, context, bundle, picture=None, kind='image', datasource=None):
@@ -328,20 +1337,18 @@ class MetadataService(object):
         self.database.templates.create_index('id')
         self.database.templates.create_index('bundle')
 
-        self.database.templates.update_one({'id': _id}, {
-            '$set': {
-                'name': name,
-                'language': language,
-                'context': context,
-                'bundle': bundle,
-                'creation_date': datetime.datetime.utcnow(),
-                'picture': picture,
-                'kind': kind,
-                'datasource': datasource
-            }
-        }, upsert=True)
+        doc = {
+            'name': name,
+            'language': language,
+            'context': context,
+            'bundle': bundle,
+            'picture': picture,
+            'kind': kind,
+            'datasource': datasource
+        }
+        changed = self._upsert('templates', _id, doc)
 
-        return {'id': _id}
+        return {'id': _id, 'changed': changed}
 
     @rpc
     def delete_template(self, _id):
@@ -349,10 +1356,31 @@ class MetadataService(object):
         if t is not None:
             raise MetadataServiceError(
                 'Trigger {} depends on template {}. Cannot delete it'.format(t['id'], _id))
-        self.database.templates.delete_one({'id': _id})
+        if self.database.templates.delete_one({'id': _id}).deleted_count != 0:
+            self._record_change('templates', _id, 'delete')
 
         return {'id': _id}
 
+    @rpc
+    def delete_templates(self, ids, cascade=False):
+        ids = list(dict.fromkeys(ids))
+        triggers = sorted(t['id'] for t in self.database.triggers.find({'template.id': {'$in': ids}},
+                                                                       {'_id': 0, 'id': 1}))
+
+        if len(triggers) != 0:
+            if cascade is not True:
+                raise MetadataServiceError('Triggers {} depend on deleted templates'.format(triggers))
+
+            self.database.triggers.bulk_write([DeleteMany({'id': {'$in': triggers}})])
+            self._record_changes('triggers', triggers, 'delete')
+
+        deleted = sorted(t['id'] for t in self.database.templates.find({'id': {'$in': ids}}, {'_id': 0, 'id': 1}))
+        if len(deleted) != 0:
+            self.database.templates.bulk_write([DeleteMany({'id': {'$in': deleted}})])
+            self._record_changes('templates', deleted, 'delete')
+
+        return {'deleted': {'triggers': triggers, 'templates': deleted}}
+
     @staticmethod
     def __build_projection_doc(include_svg):
         if not include_svg:
@@ -360,89 +1388,172 @@ class MetadataService(object):
         return {'_id': 0, 'queries': 0, 'allowed_users': 0}
 
     @rpc
+    @single_flight
+    @in_lane('light')
     def get_all_templates(self, user, include_svg = False):
         cursor = self.database.templates.find({'allowed_users': user},
                                               MetadataService.__build_projection_doc(include_svg))\
                                               .sort('id', ASCENDING)
 
-        return bson.json_util.dumps(list(cursor))
+        return bson.json_util.dumps(self._inflate('templates', list(cursor)))
 
     @rpc
+    @single_flight
+    @in_lane('light')
     def get_templates_by_bundle(self, bundle, user, include_svg = False):
         cursor = self.database.templates.find({'bundle': bundle, 'allowed_users': user},
                                               MetadataService.__build_projection_doc(include_svg))\
                                               .sort('id', ASCENDING)
 
-        return bson.json_util.dumps(list(cursor))
+        return bson.json_util.dumps(self._inflate('templates', list(cursor)))
 
     @rpc
+    @in_lane('light')
     def get_template(self, _id, user):
-        return bson.json_util.dumps(self.database.templates.find_one({'id': _id, 'allowed_users': user},
-                                                                     {'_id': 0}))
+        template = self.database.templates.find_one({'id': _id, 'allowed_users': user}, {'_id': 0})
+
+        return bson.json_util.dumps(self._inflate('templates', [template])[0])
 
     @rpc
-    def add_query_to_template(self, _id, query_id, referential_parameters=None, labels=None, referential_results=None,
+    @in_lane('light')
+    def get_templates(self, ids, user):
+        return self._find_by_ids(self.database.templates, ids, query={'allowed_users': user})
+
+    @staticmethod
+    def _check_referential_parameters(query, referential_parameters):
+        if referential_parameters is None:
+            return
+
+        query_parameters = query['parameters']
+        if query_parameters is None:
+            raise MetadataServiceError(
+                'Query {} does not have parameters'.format(query['id']))
+        check_ref_params = [list(r.keys())[0] for r in referential_parameters if
+                            list(r.keys())[0] in query_parameters]
+
+        if len(check_ref_params) != len(referential_parameters):
+            raise MetadataServiceError('Some referential parameters mismatching query {} parameters'
+                                       .format(query['id']))
+
+    @staticmethod
+    def _build_template_query(query_id, referential_parameters=None, labels=None, referential_results=None,
                               user_parameters=None, limit=50):
-        template = self.database.templates.find_one({'id': _id})
+        return {
+            'id': query_id,
+            'referential_parameters': referential_parameters,
+            'labels': labels,
+            'referential_results': referential_results,
+            'user_parameters': user_parameters,
+            'limit': limit
+        }
 
-        if template is None:
-            raise MetadataServiceError('Template {} not found'.format(_id))
+    @staticmethod
+    def _merge_template_queries(entries):
+        # Replaces the embedded queries sharing an id with one of the entries in place and appends the others,
+        # so that the whole merge is done by the server in a single atomic update
+        return {
+            '$let': {
+                'vars': {
+                    'current': {'$ifNull': ['$queries', []]},
+                    'entries': {'$literal': entries}
+                },
+                'in': {
+                    '$concatArrays': [
+                        {
+                            '$map': {
+                                'input': '$$current',
+                                'as': 'query',
+                                'in': {
+                                    '$let': {
+                                        'vars': {
+                                            'matches': {
+                                                '$filter': {
+                                                    'input': '$$entries',
+                                                    'as': 'entry',
+                                                    'cond': {'$eq': ['$$entry.id', '$$query.id']}
+                                                }
+                                            }
+                                        },
+                                        'in': {
+                                            '$cond': [
+                                                {'$eq': [{'$size': '$$matches'}, 0]},
+                                                '$$query',
+                                                {'$arrayElemAt': ['$$matches', 0]}
+                                            ]
+                                        }
+                                    }
+                                }
+                            }
+                        },
+                        {
+                            '$filter': {
+                                'input': '$$entries',
+                                'as': 'entry',
+                                'cond': {'$not': [{'$in': ['$$entry.id', '$$current.id']}]}
+                            }
+                        }
+                    ]
+                }
+            }
+        }
 
-        query = self.database.queries.find_one({'id': query_id})
+    @rpc
+    def add_query_to_template(self, _id, query_id, referential_parameters=None, labels=None, referential_results=None,
+                              user_parameters=None, limit=50):
+        query = self.database.queries.find_one({'id': query_id}, {'_id': 0, 'id': 1, 'parameters': 1})
 
         if query is None:
             raise MetadataServiceError('Query {} not found'.format(query_id))
 
-        if referential_parameters is not None:
-            query_parameters = query['parameters']
-            if query_parameters is None:
-                raise MetadataServiceError(
-                    'Query {} does not have parameters'.format(query_id))
-            check_ref_params = [list(r.keys())[0] for r in referential_parameters if
-                                list(r.keys())[0] in query_parameters]
+        self._check_referential_parameters(query, referential_parameters)
 
-            if len(check_ref_params) != len(referential_parameters):
-                raise MetadataServiceError('Some referential parameters mismatching query {} parameters'
-                                           .format(query_id))
+        entry = self._build_template_query(query_id, referential_parameters=referential_parameters, labels=labels,
+                                           referential_results=referential_results,
+                                           user_parameters=user_parameters, limit=limit)
 
         res = self.database.templates.update_one(
-            {
-                'id': _id,
-                'queries': {
-                    '$not': {
-                        '$elemMatch': {
-                            'id': query_id
-                        }
-                    }
-                }
-            },
-            {
-                '$addToSet': {
-                    'queries': {
-                        'id': query_id,
-                        'referential_parameters': referential_parameters,
-                        'labels': labels,
-                        'referential_results': referential_results,
-                        'user_parameters': user_parameters,
-                        'limit': limit
-                    }
-                }
-            }
+            {'id': _id},
+            [{'$set': {'queries': self._merge_template_queries([entry])}}]
         )
 
-        if res.modified_count == 0:
-            res = self.database.templates.update_one(
-                {'id': _id, 'queries.id': query_id},
-                {
-                    '$set': {
-                        'queries.$.referential_parameters': referential_parameters,
-                        'queries.$.labels': labels,
-                        'queries.$.referential_results': referential_results,
-                        'queries.$.user_parameters': user_parameters,
-                        'limit': limit
-                    }
-                }
-            )
+        if res.matched_count == 0:
+            raise MetadataServiceError('Template {} not found'.format(_id))
+
+        self._record_change('templates', _id, 'update', fields=['queries'])
+
+    @rpc
+    def set_template_queries(self, _id, entries, merge=False):
+        fields = set(self._build_template_query(None))
+        for e in entries:
+            if 'id' not in e:
+                raise MetadataServiceError('ID not found in query spec')
+            if not set(e).issubset(fields):
+                raise MetadataServiceError('Unexpected fields {} in query spec'.format(sorted(set(e) - fields)))
+
+        entries = list({e['id']: self._build_template_query(e['id'], **{k: v for k, v in e.items() if k != 'id'})
+                        for e in entries}.values())
+
+        queries = {q['id']: q for q in self.database.queries.find(
+            {'id': {'$in': [e['id'] for e in entries]}}, {'_id': 0, 'id': 1, 'parameters': 1})}
+
+        for e in entries:
+            if e['id'] not in queries:
+                raise MetadataServiceError('Query {} not found'.format(e['id']))
+            self._check_referential_parameters(queries[e['id']], e['referential_parameters'])
+
+        if merge is True:
+            update = [{'$set': {'queries': self._merge_template_queries(entries)}}]
+        else:
+            update = {'$set': {'queries': entries}}
+
+        res = self.database.templates.update_one({'id': _id}, update)
+
+        if res.matched_count == 0:
+            raise MetadataServiceError('Template {} not found'.format(_id))
+
+        self._record_change('templates', _id, 'update', fields=['queries'])
+
+        return {'id': _id}
 
     @rpc
     def delete_query_from_template(self, _id, query_id):
@@ -455,32 +1566,38 @@ class MetadataService(object):
         if result.modified_count == 0:
             raise MetadataServiceError('Nothing has been deleted')
 
+        self._record_change('templates', _id, 'update', fields=['queries'])
+
     @rpc
     def update_svg_in_template(self, _id, svg):
         result = self.database.templates.update_one(
             {'id': _id, 'kind': 'image'},
             {
                 '$set': {
-                    'svg': svg
+                    'svg': self._compress(svg)
                 }
             }
         )
         if result.modified_count == 0:
             raise MetadataServiceError('Nothing has been updated')
 
+        self._record_change('templates', _id, 'update', fields=['svg'])
+
     @rpc
     def update_html_in_template(self, _id, html):
         result = self.database.templates.update_one(
             {'id': _id, 'kind': 'widget'},
             {
                 '$set': {
-                    'html': html
+                    'html': self._compress(html)
                 }
             }
         )
         if result.modified_count == 0:
             raise MetadataServiceError('Nothing has been updated')
 
+        self._record_change('templates', _id, 'update', fields=['html'])
+
     @rpc
     def add_trigger(self, _id, name, on_event, template, user, selector=[], export=None):
         self.database.triggers.create_index('id', unique=True)
@@ -490,6 +1607,8 @@ class MetadataService(object):
         if 'id' not in template:
             raise MetadataServiceError('ID not found in template spec')
 
+        self.selectors.compile(selector)
+
         check = self.database.templates.find_one({'id': template['id']})
 
         if not check:
@@ -499,22 +1618,22 @@ class MetadataService(object):
         if user not in check['allowed_users']:
             raise MetadataServiceError(f'{user} is not allowed to handle {check["id"]}')
 
-        self.database.triggers.update_one({'id': _id}, {
-            '$set': {
-                'name': name,
-                'on_event': on_event,
-                'template': template,
-                'selector': selector,
-                'user': user,
-                'export': export
-            }
-        }, upsert=True)
+        doc = {
+            'name': name,
+            'on_event': on_event,
+            'template': template,
+            'selector': selector,
+            'user': user,
+            'export': export
+        }
+        changed = self._upsert('triggers', _id, doc)
 
-        return {'id': _id}
+        return {'id': _id, 'changed': changed}
 
     @rpc
     def delete_trigger(self, _id):
-        self.database.triggers.delete_one({'id': _id})
+        if self.database.triggers.delete_one({'id': _id}).deleted_count != 0:
+            self._record_change('triggers', _id, 'delete')
 
         return {'id': _id}
 
@@ -523,14 +1642,127 @@ class MetadataService(object):
         trigger = self.database.triggers.find_one({'id': _id}, {'_id': 0})
         return bson.json_util.dumps(trigger)
 
+    @rpc
+    def get_triggers(self, ids):
+        return self._find_by_ids(self.database.triggers, ids)
+
     @rpc
     def get_all_triggers(self):
         cursor = self.database.triggers.find({}, {'_id': 0})
         return bson.json_util.dumps(list(cursor))
 
     @rpc
-    def get_fired_triggers(self, event_type):
+    @in_lane('light')
+    def get_fired_triggers(self, event_type, payload=None):
         cursor = self.database.triggers.find(
             {'on_event.type': event_type['type'], 'on_event.source': event_type['source']}, 
             {'_id': 0})
-        return bson.json_util.dumps(list(cursor))
+
+        if payload is None:
+            return bson.json_util.dumps(list(cursor))
+
+        return bson.json_util.dumps(select_fired(self.selectors, cursor, payload))
+
+    @rpc
+    def get_changes_since(self, seq, limit=1000):
+        changes = list(self.database.changes.find({'seq': {'$gt': seq}}, {'_id': 0})
+                       .sort('seq', ASCENDING).limit(limit))
+
+        counter = self.database.counters.find_one({'_id': 'changes'})
+        last_seq = counter['seq'] if counter is not None else 0
+
+        # Changes after a gap are held back until the missing sequence is written or given up as lost, then the
+        # consumer is asked to reload everything
+        changes, lost = split_changes(changes, seq, self.CHANGE_GAP_GRACE)
+        reset = seq > last_seq or (len(changes) == 0 and lost)
+        for c in changes:
+            del c['date']
+
+        return bson.json_util.dumps({'changes': changes, 'last_seq': last_seq, 'reset': reset})
+
+    def _find_archivable(self, cutoff, transformations_cutoff=None):
+        found = {}
+
+        # Long unprocessed transformations are archived only when nothing left in place depends on them or is
+        # triggered by their target table
+        transformations = list(self.database.transformations.find({}, {
+            '_id': 0, 'id': 1, 'depends_on': 1, 'process_date': 1, 'creation_date': 1, 'function_only': 1,
+            'function_hash': 1, 'target_table': 1, 'trigger_tables': 1}))
+
+        archivable = set()
+        if transformations_cutoff is not None:
+            archivable = set(t['id'] for t in transformations if t.get('function_only') is not True and (
+                t.get('process_date') or t.get('creation_date') or transformations_cutoff) < transformations_cutoff)
+
+        producers = {}
+        for t in transformations:
+            if t.get('target_table') is not None:
+                producers.setdefault(t['target_table'], []).append(t['id'])
+
+        changed = True
+        while changed:
+            changed = False
+            for t in transformations:
+                if t['id'] not in archivable:
+                    referenced = get_dependencies(t)
+                    for table in t.get('trigger_tables') or []:
+                        referenced.extend(producers.get(table, []))
+                    for dependency in archivable.intersection(referenced):
+                        archivable.discard(dependency)
+                        changed = True
+        found['transformations'] = sorted(archivable)
+
+        used = set(t.get('function_hash') for t in transformations if t['id'] not in archivable)
+        found['functions'] = sorted(f['hash'] for f in self.database.functions.find(
+            {'creation_date': {'$lt': cutoff}}, {'_id': 0, 'hash': 1}) if f['hash'] not in used)
+
+        used = set(self.database.templates.distinct('queries.id'))
+        found['queries'] = sorted(q['id'] for q in self.database.queries.find(
+            {'creation_date': {'$lt': cutoff}}, {'_id': 0, 'id': 1}) if q['id'] not in used)
+
+        templates = set(self.database.templates.distinct('id'))
+        found['triggers'] = sorted(t['id'] for t in self.database.triggers.find({}, {'_id': 0, 'id': 1, 'template': 1})
+                                   if (t.get('template') or {}).get('id') not in templates)
+
+        return found
+
+    def _archive(self, collection, ids, key='id'):
+        archived = 0
+        for i in range(0, len(ids), self.archive_policy.batch_size):
+            docs = list(self.database[collection].find({key: {'$in': ids[i:i + self.archive_policy.batch_size]}}))
+            if len(docs) == 0:
+                continue
+
+            date = datetime.datetime.utcnow()
+            self.database['archive_{}'.format(collection)].bulk_write([
+                ReplaceOne({'_id': d['_id']}, dict(d, archive_date=date), upsert=True) for d in docs
+            ])
+            self.database[collection].delete_many({'_id': {'$in': [d['_id'] for d in docs]}})
+            self._record_changes(collection, [d[key] for d in docs], 'delete')
+
+            archived += len(docs)
+
+        return archived
+
+    @rpc
+    def archive_stale_metadata(self, dry_run=False):
+        cutoff = self.archive_policy.cutoff()
+        if cutoff is None:
+            return {}
+
+        found = self._find_archivable(cutoff, transformations_cutoff=self.archive_policy.transformations_cutoff())
+        if dry_run is True:
+            return found
+
+        report = {}
+        for collection in ('transformations', 'functions', 'queries', 'triggers'):
+            report[collection] = self._archive(collection, found[collection],
+                                               key='hash' if collection == 'functions' else 'id')
+
+        _logger.info('Archived stale metadata: {}'.format(report))
+        return report
+
+    @timer(interval=3600)
+    @in_lane('background')
+    def compact(self):
+        self.archive_stale_metadata()
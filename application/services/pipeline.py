@@ -0,0 +1,198 @@
+import heapq
+
+PIPELINE_FIELDS = ('id', 'materialized', 'function_name', 'function_hash', 'target_table', 'function_only', 'type',
+                   'input', 'output', 'parameters', 'process_date', 'depends_on')
+
+DEFAULT_DURATION = 1.
+
+
+def expected_duration(transformation, default=DEFAULT_DURATION):
+    # Recent runs weigh more than older ones so that the estimate follows the growth of the processed data
+    durations = [s['duration'] for s in transformation.get('stats') or [] if s.get('duration') is not None]
+
+    if len(durations) == 0:
+        return default
+
+    estimate = durations[0]
+    for duration in durations[1:]:
+        estimate = 0.5 * estimate + 0.5 * duration
+
+    return estimate
+
+
+def get_dependencies(transformation):
+    # Documents written before several dependencies were allowed hold a single id in depends_on
+    depends_on = transformation.get('depends_on')
+    if depends_on is None:
+        return []
+    if not isinstance(depends_on, list):
+        return [depends_on]
+    return list(depends_on)
+
+
+def get_ancestors(transformations):
+    # Maps each transformation id to the ids of all its ancestors through depends_on, visiting shared ancestors
+    # only once
+    parents = {t['id']: get_dependencies(t) for t in transformations}
+
+    ancestors = {}
+
+    def visit(_id):
+        if _id not in ancestors:
+            # Set before visiting the parents so that a cycle can not recurse forever
+            ancestors[_id] = []
+            found = {}
+            for parent in parents.get(_id, []):
+                if parent in parents and parent != _id:
+                    found[parent] = None
+                    found.update((a, None) for a in visit(parent) if a != _id)
+            ancestors[_id] = list(found)
+        return ancestors[_id]
+
+    for _id in parents:
+        visit(_id)
+
+    return ancestors
+
+
+def get_upstream(transformations):
+    # Maps each transformation id to the ids of the other pipeline transformations it has to wait for, either
+    # because they are among its dependencies or because they build one of its trigger tables
+    ids = set(t['id'] for t in transformations)
+
+    producers = {}
+    for t in transformations:
+        if t.get('target_table') is not None:
+            producers.setdefault(t['target_table'], set()).add(t['id'])
+
+    upstream = {}
+    for t in transformations:
+        parents = set(d['id'] for d in t.get('dependencies') or []) & ids
+        for table in t.get('trigger_tables') or []:
+            parents |= producers.get(table, set())
+        parents.discard(t['id'])
+        upstream[t['id']] = parents
+
+    return upstream
+
+
+def is_outdated(transformation, table_dates):
+    process_date = transformation.get('process_date')
+
+    if process_date is None:
+        return True
+
+    if any(table_dates.get(table) is not None and table_dates[table] > process_date
+           for table in transformation.get('trigger_tables') or []):
+        return True
+
+    return any(d.get('process_date') is not None and d['process_date'] > process_date
+               for d in transformation.get('dependencies') or [])
+
+
+def find_stale(transformations, table_dates):
+    upstream = get_upstream(transformations)
+    by_id = {t['id']: t for t in transformations}
+    stale = {}
+
+    def visit(_id):
+        if _id not in stale:
+            # Set before visiting the parents so that a cycle can not recurse forever
+            stale[_id] = is_outdated(by_id[_id], table_dates)
+            stale[_id] = any([stale[_id]] + [visit(p) for p in upstream[_id]])
+        return stale[_id]
+
+    return [t for t in transformations if visit(t['id'])]
+
+
+def plan_job(transformations):
+    # Orders the transformations of a job so that, among the ones whose upstream is done, the one heading the
+    # longest remaining path to the end of the job comes first, and computes the expected makespan of the job
+    by_id = {t['id']: t for t in transformations}
+    upstream = get_upstream(transformations)
+
+    downstream = {_id: set() for _id in by_id}
+    for _id, parents in upstream.items():
+        for parent in parents:
+            downstream[parent].add(_id)
+
+    remaining = {}
+    successor = {}
+
+    def visit(_id):
+        if _id not in remaining:
+            # Set before visiting the children so that a cycle can not recurse forever
+            remaining[_id] = expected_duration(by_id[_id])
+            children = sorted(downstream[_id], key=lambda c: (-visit(c), c))
+            successor[_id] = children[0] if children else None
+            remaining[_id] += remaining[children[0]] if children else 0.
+        return remaining[_id]
+
+    for _id in by_id:
+        visit(_id)
+
+    waiting = {_id: len(parents) for _id, parents in upstream.items()}
+    ready = [(-remaining[_id], _id) for _id, count in waiting.items() if count == 0]
+    heapq.heapify(ready)
+
+    order = []
+    while ready:
+        _, _id = heapq.heappop(ready)
+        order.append(_id)
+        for child in downstream[_id]:
+            waiting[child] -= 1
+            if waiting[child] == 0:
+                heapq.heappush(ready, (-remaining[child], child))
+
+    # Transformations caught in a cycle never become ready, they are still returned after the others
+    order += sorted((_id for _id in by_id if _id not in order), key=lambda i: len(by_id[i].get('dependencies') or []))
+
+    critical_path = []
+    if len(order) != 0:
+        head = max(by_id, key=lambda i: (remaining[i], -len(upstream[i])))
+        while head is not None and head not in critical_path:
+            critical_path.append(head)
+            head = successor[head]
+
+    return {
+        'order': order,
+        'upstream': upstream,
+        'priorities': remaining,
+        'makespan': max(remaining.values()) if remaining else 0.,
+        'critical_path': critical_path
+    }
+
+
+def build_pipeline(transformations, lean=False):
+    jobs = {}
+    for t in transformations:
+        jobs.setdefault(t['job_id'], []).append(t)
+
+    pipeline = []
+    for job_id in sorted(jobs):
+        plan = plan_job(jobs[job_id])
+        by_id = {t['id']: t for t in jobs[job_id]}
+
+        entries = []
+        for _id in plan['order']:
+            t = by_id[_id]
+            dependencies = t.get('dependencies') or []
+            if lean is True:
+                dependencies = [d['id'] for d in dependencies]
+            entry = dict({f: t.get(f) for f in PIPELINE_FIELDS}, index=len(dependencies),
+                         dependencies=dependencies, upstream=sorted(plan['upstream'][_id]),
+                         expected_duration=expected_duration(t), priority=plan['priorities'][_id])
+            # Executors fetch function texts by hash with get_functions, only legacy transformations embed them
+            if t.get('function_hash') is None:
+                entry['function'] = t.get('function')
+            entries.append(entry)
+
+        pipeline.append({
+            '_id': job_id,
+            'job_id': job_id,
+            'transformations': entries,
+            'makespan': plan['makespan'],
+            'critical_path': plan['critical_path']
+        })
+
+    return pipeline
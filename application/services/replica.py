@@ -0,0 +1,388 @@
+import logging
+from nameko.rpc import rpc
+from nameko.timer import timer
+from nameko.dependency_providers import DependencyProvider
+import bson.json_util
+from nameko_mongodb.database import MongoDatabase
+from pymongo import ASCENDING
+
+from application.services.metadata import MetadataService, MetadataServiceError, ErrorHandler, SelectorCache, \
+    select_fired, split_changes
+from application.services.pipeline import build_pipeline, find_stale, get_dependencies
+
+_logger = logging.getLogger(__name__)
+
+
+def _event_key(on_event):
+    if not isinstance(on_event, dict):
+        return []
+    return [(on_event.get('type'), on_event.get('source'))]
+
+
+class Catalog(DependencyProvider):
+
+    COLLECTIONS = {
+        'transformations': 'id',
+        'functions': 'hash',
+        'queries': 'id',
+        'templates': 'id',
+        'triggers': 'id',
+        'subscriptions': 'user'
+    }
+
+    INDEXES = {
+        'transformations': {'trigger_tables': lambda doc: doc.get('trigger_tables') or []},
+        'templates': {
+            'bundle': lambda doc: [doc.get('bundle')],
+            'allowed_users': lambda doc: doc.get('allowed_users') or []
+        },
+        'triggers': {'on_event': lambda doc: _event_key(doc.get('on_event'))}
+    }
+
+    def __init__(self, batch_size=1000, gap_grace=MetadataService.CHANGE_GAP_GRACE):
+        self.batch_size = batch_size
+        self.gap_grace = gap_grace
+        self.collections = {name: {} for name in self.COLLECTIONS}
+        self.indexes = {name: {index: {} for index in indexes} for name, indexes in self.INDEXES.items()}
+        self.tables = {}
+        self.seq = None
+
+    def setup(self):
+        self.batch_size = self.container.config.get('REPLICA_SYNC_BATCH_SIZE', self.batch_size)
+        self.gap_grace = self.container.config.get('REPLICA_GAP_GRACE', self.gap_grace)
+
+    def get_dependency(self, worker_ctx):
+        return self
+
+    @property
+    def ready(self):
+        return self.seq is not None
+
+    def _index(self, name, doc, add):
+        for index, keys in self.INDEXES.get(name, {}).items():
+            for value in keys(doc):
+                ids = self.indexes[name][index].setdefault(value, set())
+                if add is True:
+                    ids.add(doc[self.COLLECTIONS[name]])
+                else:
+                    ids.discard(doc[self.COLLECTIONS[name]])
+                    if len(ids) == 0:
+                        del self.indexes[name][index][value]
+
+    def _put(self, name, doc):
+        self._remove(name, doc[self.COLLECTIONS[name]])
+        self.collections[name][doc[self.COLLECTIONS[name]]] = doc
+        self._index(name, doc, True)
+
+    def _remove(self, name, key):
+        doc = self.collections[name].pop(key, None)
+        if doc is not None:
+            self._index(name, doc, False)
+
+    def hydrate(self, database):
+        # The sequence is read before loading the collections so that writes made during the load are replayed
+        # from the change log afterwards
+        counter = database.counters.find_one({'_id': 'changes'})
+        seq = counter['seq'] if counter is not None else 0
+
+        collections = {name: list(database[name].find({}, {'_id': 0})) for name in self.COLLECTIONS}
+        tables = {t['table']: t['update_date'] for t in database.tables.find({}, {'_id': 0, 'table': 1,
+                                                                                 'update_date': 1})}
+
+        self.collections = {name: {} for name in self.COLLECTIONS}
+        self.indexes = {name: {index: {} for index in indexes} for name, indexes in self.INDEXES.items()}
+        for name, docs in collections.items():
+            for doc in docs:
+                self._put(name, doc)
+        self.tables = tables
+        self.seq = seq
+
+        _logger.info('Catalog hydrated at sequence {} with {}'.format(seq, self.count()))
+
+        self.sync(database)
+
+    def sync(self, database):
+        if self.seq is None:
+            return self.hydrate(database)
+
+        while True:
+            fetched_changes = list(database.changes.find({'seq': {'$gt': self.seq}}, {'_id': 0})
+                                   .sort('seq', ASCENDING).limit(self.batch_size))
+            changes, lost = split_changes(fetched_changes, self.seq, self.gap_grace)
+
+            if len(changes) == 0:
+                if lost is True:
+                    _logger.warning('Change log no longer holds sequence {}, hydrating the catalog again'
+                                    .format(self.seq + 1))
+                    self.seq = None
+                    return self.hydrate(database)
+                break
+
+            ops = {}
+            for c in changes:
+                if c['collection'] in self.COLLECTIONS:
+                    ops.setdefault(c['collection'], {})[c['id']] = c['op']
+
+            fetched = {}
+            for name, keys in ops.items():
+                upserted = [k for k, op in keys.items() if op != 'delete']
+                key = self.COLLECTIONS[name]
+                fetched[name] = {doc[key]: doc for doc in database[name].find({key: {'$in': upserted}}, {'_id': 0})}
+
+            for name, keys in ops.items():
+                for k in keys:
+                    if k in fetched[name]:
+                        self._put(name, fetched[name][k])
+                    else:
+                        self._remove(name, k)
+
+            self.seq = changes[-1]['seq']
+
+            # A gap met within a batch is handled at the start of the next one
+            if len(fetched_changes) < self.batch_size:
+                break
+
+        self.tables = {t['table']: t['update_date'] for t in database.tables.find({}, {'_id': 0, 'table': 1,
+                                                                                      'update_date': 1})}
+
+    def get(self, name, key):
+        doc = self.collections[name].get(key)
+        return dict(doc) if doc is not None else None
+
+    def find(self, name, index=None, value=None):
+        if index is None:
+            return [dict(doc) for doc in self.collections[name].values()]
+
+        ids = self.indexes[name][index].get(value, set())
+        return [dict(self.collections[name][i]) for i in sorted(ids)]
+
+    def count(self):
+        return {name: len(docs) for name, docs in self.collections.items()}
+
+
+def _exclude(docs, fields):
+    return [{k: v for k, v in doc.items() if k not in fields} for doc in docs]
+
+
+class MetadataDatabase(MongoDatabase):
+    # The replica reads the database of the metadata service: MONGODB_DB_NAME when it is set, otherwise the name
+    # of the metadata service instead of the name of the replica
+    def setup(self):
+        super(MetadataDatabase, self).setup()
+        self.database = self.client[self.container.config.get('MONGODB_DB_NAME', MetadataService.name)]
+
+
+class MetadataReplicaService(object):
+    name = 'metadata_replica'
+    error = ErrorHandler()
+    database = MetadataDatabase(result_backend=False)
+    catalog = Catalog()
+    selectors = SelectorCache()
+
+    @timer(interval=1, eager=True)
+    def sync_catalog(self):
+        self.catalog.sync(self.database)
+
+    def _check_ready(self):
+        if not self.catalog.ready:
+            raise MetadataServiceError('Replica catalog is not hydrated yet')
+
+    def _resolve_functions(self, transformations):
+        for t in transformations:
+            if 'function' not in t and t.get('function_hash') is not None:
+                function = self.catalog.get('functions', t['function_hash'])
+                if function is not None:
+                    t['function'] = MetadataService._inflate('functions', [function])[0]['function']
+        return transformations
+
+    def _lookup_ids(self, name, ids, user=None):
+        ids = list(dict.fromkeys(ids))
+
+        found = {}
+        for i in ids:
+            doc = self.catalog.get(name, i)
+            if doc is not None and (user is None or user in (doc.get('allowed_users') or [])):
+                found[i] = doc
+        MetadataService._inflate(name, found.values())
+
+        return {
+            'results': [found[i] for i in ids if i in found],
+            'missing': [i for i in ids if i not in found]
+        }
+
+    @rpc
+    def get_replica_status(self):
+        return {'ready': self.catalog.ready, 'seq': self.catalog.seq, 'counts': self.catalog.count()}
+
+    @rpc
+    def get_types(self):
+        return MetadataService.TYPES
+
+    @rpc
+    def get_all_transformations(self):
+        self._check_ready()
+        return bson.json_util.dumps(_exclude(self.catalog.find('transformations'),
+                                             ('input', 'function', 'output', 'parameters')))
+
+    @rpc
+    def get_transformation(self, _id):
+        self._check_ready()
+        transformation = self.catalog.get('transformations', _id)
+
+        if transformation is not None:
+            self._resolve_functions([transformation])
+
+        return bson.json_util.dumps(transformation)
+
+    @rpc
+    def get_transformations(self, ids):
+        self._check_ready()
+        found = self._lookup_ids('transformations', ids)
+        self._resolve_functions(found['results'])
+
+        return bson.json_util.dumps(found)
+
+    @rpc
+    def get_functions(self, hashes):
+        self._check_ready()
+        return bson.json_util.dumps(self._lookup_ids('functions', hashes))
+
+    def _find_pipeline_transformations(self, tables, lean=False):
+        # Transformations triggered by the tables, then everything downstream through their target tables within
+        # the same job like the metadata service
+        triggered = {}
+        pending = [(table, None) for table in tables]
+        seen = set()
+        while pending:
+            table, job_id = pending.pop()
+            if (table, job_id) in seen:
+                continue
+            seen.add((table, job_id))
+            for t in self.catalog.find('transformations', 'trigger_tables', table):
+                if t['id'] not in triggered and job_id in (None, t['job_id']):
+                    triggered[t['id']] = t
+                    if t.get('target_table') is not None:
+                        pending.append((t['target_table'], t['job_id']))
+
+        transformations = list(triggered.values())
+        job_ids = set(t['job_id'] for t in transformations)
+
+        for t in transformations:
+            ancestors = {}
+            parents = get_dependencies(t)
+            while parents:
+                parent = self.catalog.get('transformations', parents.pop())
+                if parent is None or parent['id'] in ancestors:
+                    continue
+                if lean is True and parent['job_id'] not in job_ids:
+                    continue
+                ancestors[parent['id']] = parent
+                parents.extend(get_dependencies(parent))
+            ancestors.pop(t['id'], None)
+
+            if lean is True:
+                t['dependencies'] = [{'id': a['id'], 'depends_on': a.get('depends_on'),
+                                      'process_date': a.get('process_date')} for a in ancestors.values()]
+            else:
+                t['dependencies'] = list(ancestors.values())
+
+        return transformations
+
+    @rpc
+    def get_update_pipeline(self, table, lean=False):
+        self._check_ready()
+        result = build_pipeline(self._find_pipeline_transformations([table], lean=lean), lean=lean)
+
+        if len(result) != 0:
+            return bson.json_util.dumps(result)
+
+        return None
+
+    @rpc
+    def get_stale_pipeline(self, table, lean=False):
+        self._check_ready()
+        transformations = self._find_pipeline_transformations([table], lean=lean)
+
+        result = build_pipeline(find_stale(transformations, self.catalog.tables), lean=lean)
+
+        if len(result) != 0:
+            return bson.json_util.dumps(result)
+
+        return None
+
+    @rpc
+    def get_all_queries(self):
+        self._check_ready()
+        return bson.json_util.dumps(_exclude(self.catalog.find('queries'), ('sql', 'parameters')))
+
+    @rpc
+    def get_query(self, _id):
+        self._check_ready()
+        return bson.json_util.dumps(MetadataService._inflate('queries', [self.catalog.get('queries', _id)])[0])
+
+    @rpc
+    def get_queries(self, ids):
+        self._check_ready()
+        return bson.json_util.dumps(self._lookup_ids('queries', ids))
+
+    @staticmethod
+    def _template_fields(include_svg):
+        if not include_svg:
+            return ('svg', 'queries', 'allowed_users')
+        return ('queries', 'allowed_users')
+
+    @rpc
+    def get_all_templates(self, user, include_svg=False):
+        self._check_ready()
+        templates = _exclude(self.catalog.find('templates', 'allowed_users', user), self._template_fields(include_svg))
+
+        return bson.json_util.dumps(MetadataService._inflate('templates', templates))
+
+    @rpc
+    def get_templates_by_bundle(self, bundle, user, include_svg=False):
+        self._check_ready()
+        templates = [t for t in self.catalog.find('templates', 'bundle', bundle)
+                     if user in (t.get('allowed_users') or [])]
+        templates = _exclude(templates, self._template_fields(include_svg))
+
+        return bson.json_util.dumps(MetadataService._inflate('templates', templates))
+
+    @rpc
+    def get_template(self, _id, user):
+        self._check_ready()
+        template = self.catalog.get('templates', _id)
+
+        if template is None or user not in (template.get('allowed_users') or []):
+            return bson.json_util.dumps(None)
+
+        return bson.json_util.dumps(MetadataService._inflate('templates', [template])[0])
+
+    @rpc
+    def get_templates(self, ids, user):
+        self._check_ready()
+        return bson.json_util.dumps(self._lookup_ids('templates', ids, user=user))
+
+    @rpc
+    def get_trigger(self, _id):
+        self._check_ready()
+        return bson.json_util.dumps(self.catalog.get('triggers', _id))
+
+    @rpc
+    def get_triggers(self, ids):
+        self._check_ready()
+        return bson.json_util.dumps(self._lookup_ids('triggers', ids))
+
+    @rpc
+    def get_all_triggers(self):
+        self._check_ready()
+        return bson.json_util.dumps(self.catalog.find('triggers'))
+
+    @rpc
+    def get_fired_triggers(self, event_type, payload=None):
+        self._check_ready()
+        triggers = self.catalog.find('triggers', 'on_event', (event_type['type'], event_type['source']))
+
+        if payload is None:
+            return bson.json_util.dumps(triggers)
+
+        return bson.json_util.dumps(select_fired(self.selectors, triggers, payload))
@@ -0,0 +1,140 @@
+"""Streams the metadata collections to and from a gzip compressed BSON snapshot.
+
+    python -m application.snapshot export --db-url mongodb://localhost:27017 --db-name metadata snapshot.bson.gz
+    python -m application.snapshot import --db-url mongodb://localhost:27017 --db-name metadata snapshot.bson.gz
+"""
+import argparse
+import gzip
+import logging
+
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient
+
+_logger = logging.getLogger(__name__)
+
+HEADER = '__collection__'
+
+RAW = CodecOptions(document_class=RawBSONDocument)
+
+
+def _indexes(collection):
+    indexes = []
+    for name, spec in collection.index_information().items():
+        if name == '_id_':
+            continue
+        options = {k: v for k, v in spec.items() if k not in ('key', 'v', 'ns')}
+        indexes.append({'name': name, 'key': [list(k) for k in spec['key']], 'options': options})
+    return indexes
+
+
+def export_snapshot(database, path, collections=None):
+    # Documents are copied as raw BSON without being decoded, one collection after the other behind a header
+    # holding its options and indexes
+    if collections is None:
+        collections = sorted(c for c in database.list_collection_names() if not c.startswith('system.'))
+
+    counts = {}
+    with gzip.open(path, 'wb') as f:
+        for name in collections:
+            collection = database.get_collection(name, codec_options=RAW)
+            f.write(bson.BSON.encode({HEADER: name, 'options': collection.options(),
+                                      'indexes': _indexes(collection)}))
+
+            counts[name] = 0
+            for doc in collection.find({}, sort=[('$natural', 1)]):
+                f.write(doc.raw)
+                counts[name] += 1
+
+    _logger.info('Exported {}'.format(counts))
+    return counts
+
+
+def _collections(path):
+    with gzip.open(path, 'rb') as f:
+        return [doc[HEADER] for doc in bson.decode_file_iter(f, codec_options=RAW) if HEADER in doc]
+
+
+def import_snapshot(database, path, batch_size=1000, drop=False):
+    # Every target collection is checked before anything is written so that a refused import leaves the database
+    # as it was
+    existing = set(database.list_collection_names())
+    if drop is not True:
+        not_empty = [name for name in _collections(path)
+                     if name in existing and database[name].estimated_document_count() != 0]
+        if len(not_empty) != 0:
+            raise ValueError('Collections {} are not empty'.format(', '.join(not_empty)))
+
+    counts = {}
+    indexes = {}
+
+    collection = None
+    batch = []
+
+    def flush():
+        if len(batch) != 0:
+            collection.insert_many(batch, ordered=True, bypass_document_validation=True)
+            counts[collection.name] += len(batch)
+            del batch[:]
+
+    with gzip.open(path, 'rb') as f:
+        for doc in bson.decode_file_iter(f, codec_options=RAW):
+            if HEADER in doc:
+                flush()
+
+                name = doc[HEADER]
+                if name in existing:
+                    database.drop_collection(name)
+
+                options = dict(doc['options'])
+                if len(options) != 0:
+                    database.create_collection(name, **options)
+
+                collection = database.get_collection(name, codec_options=RAW)
+                counts[name] = 0
+                indexes[name] = [dict(i) for i in doc['indexes']]
+                continue
+
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                flush()
+
+        flush()
+
+    # Indexes are built once the documents are loaded rather than maintained on every insert
+    for name, specs in indexes.items():
+        for spec in specs:
+            database[name].create_index([tuple(k) for k in spec['key']], name=spec['name'], **dict(spec['options']))
+
+    _logger.info('Imported {}'.format(counts))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=('export', 'import'))
+    parser.add_argument('path')
+    parser.add_argument('--db-url', default='mongodb://localhost:27017')
+    parser.add_argument('--db-name', default='metadata')
+    parser.add_argument('--collections', default=None)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--drop', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    client = MongoClient(args.db_url)
+    try:
+        database = client[args.db_name]
+        if args.command == 'export':
+            collections = args.collections.split(',') if args.collections is not None else None
+            export_snapshot(database, args.path, collections=collections)
+        else:
+            import_snapshot(database, args.path, batch_size=args.batch_size, drop=args.drop)
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import datetime
+from application.services.pipeline import build_pipeline, expected_duration, find_stale, get_ancestors, \
+    get_dependencies, get_upstream, plan_job
+
+
+def _transformation(_id, job_id='myjob', trigger_tables=None, target_table=None, dependencies=None,
+                    process_date=None, duration=None):
+    return {
+        'id': _id,
+        'job_id': job_id,
+        'function_name': 'my_function',
+        'function': 'CREATE FUNCTION my_function (data DOUBLE) RETURN TABLE (result DOUBLE) LANGUAGE PYTHON{}',
+        'trigger_tables': trigger_tables,
+        'target_table': target_table,
+        'dependencies': dependencies or [],
+        'process_date': process_date,
+        'stats': [{'duration': duration}] if duration is not None else []
+    }
+
+
+def test_get_dependencies():
+    assert get_dependencies({'id': '0'}) == []
+    assert get_dependencies({'id': '1', 'depends_on': 'base'}) == ['base']
+    assert get_dependencies({'id': '2', 'depends_on': ['base', '1']}) == ['base', '1']
+
+
+def test_get_ancestors():
+    ancestors = get_ancestors([
+        {'id': '0', 'depends_on': None},
+        {'id': '1', 'depends_on': '0'},
+        {'id': '2', 'depends_on': ['0']},
+        {'id': '3', 'depends_on': ['1', '2', 'other']},
+        {'id': '4', 'depends_on': ['5']},
+        {'id': '5', 'depends_on': ['4']}
+    ])
+
+    assert ancestors['0'] == []
+    assert ancestors['1'] == ['0']
+    assert sorted(ancestors['3']) == ['0', '1', '2']
+    assert ancestors['4'] == ['5']
+
+
+def test_get_upstream():
+    first = _transformation('0', trigger_tables=['source'], target_table='first')
+    second = _transformation('1', trigger_tables=['first'], target_table='second')
+    third = _transformation('2', trigger_tables=['source'], dependencies=[first, _transformation('other')])
+
+    assert get_upstream([first, second, third]) == {'0': set(), '1': {'0'}, '2': {'0'}}
+
+
+def test_find_stale():
+    now = datetime.datetime.utcnow()
+    hour = datetime.timedelta(hours=1)
+
+    first = _transformation('0', trigger_tables=['source'], target_table='first', process_date=now - hour)
+    second = _transformation('1', trigger_tables=['first'], target_table='second', process_date=now)
+    third = _transformation('2', trigger_tables=['other'], dependencies=[first], process_date=now - 2 * hour)
+    fourth = _transformation('3', trigger_tables=['other'], process_date=now)
+    fifth = _transformation('4', trigger_tables=['other'])
+
+    transformations = [first, second, third, fourth, fifth]
+
+    stale = find_stale(transformations, {'source': now - 2 * hour, 'first': now - hour})
+    assert [t['id'] for t in stale] == ['2', '4']
+
+    stale = find_stale(transformations, {'source': now})
+    assert [t['id'] for t in stale] == ['0', '1', '2', '4']
+
+
+def test_find_stale_cycle():
+    first = _transformation('0', trigger_tables=['second'], target_table='first')
+    second = _transformation('1', trigger_tables=['first'], target_table='second')
+
+    assert len(find_stale([first, second], {})) == 2
+
+
+def test_build_pipeline():
+    first = _transformation('0', trigger_tables=['source'])
+    second = _transformation('1', trigger_tables=['source'], dependencies=[first])
+    other = _transformation('2', job_id='otherjob', trigger_tables=['source'])
+
+    pipeline = build_pipeline([second, other, first])
+    assert [p['job_id'] for p in pipeline] == ['myjob', 'otherjob']
+    assert [t['id'] for t in pipeline[0]['transformations']] == ['0', '1']
+    assert pipeline[0]['makespan'] == 2.
+    assert pipeline[0]['transformations'][0]['priority'] == 2.
+    assert pipeline[0]['transformations'][1]['index'] == 1
+    assert pipeline[0]['transformations'][1]['dependencies'][0]['id'] == '0'
+    assert pipeline[0]['transformations'][0]['function'] == first['function']
+
+    first['function_hash'] = 'hash'
+    pipeline = build_pipeline([first])
+    assert pipeline[0]['transformations'][0]['function_hash'] == 'hash'
+    assert 'function' not in pipeline[0]['transformations'][0]
+
+
+def test_expected_duration():
+    assert expected_duration({'id': '0'}) == 1.
+    assert expected_duration({'id': '0', 'stats': [{'duration': 10.}]}) == 10.
+    assert expected_duration({'id': '0', 'stats': [{'duration': 10.}, {'duration': 20.}, {'duration': None}]}) == 15.
+
+
+def test_plan_job():
+    # 0 -> 1 -> 2 is short while 3 -> 4 is long, 5 joins both branches
+    t0 = _transformation('0', trigger_tables=['source'], target_table='t0', duration=1.)
+    t1 = _transformation('1', trigger_tables=['t0'], target_table='t1', duration=1.)
+    t2 = _transformation('2', trigger_tables=['t1'], target_table='t2', duration=1.)
+    t3 = _transformation('3', trigger_tables=['source'], target_table='t3', duration=10.)
+    t4 = _transformation('4', trigger_tables=['t3'], target_table='t4', duration=10.)
+    t5 = _transformation('5', trigger_tables=['t2', 't4'], duration=2.)
+
+    plan = plan_job([t0, t1, t2, t3, t4, t5])
+    assert plan['order'] == ['3', '4', '0', '1', '2', '5']
+    assert plan['makespan'] == 22.
+    assert plan['critical_path'] == ['3', '4', '5']
+    assert plan['priorities']['0'] == 5.
+
+
+def test_plan_job_cycle():
+    first = _transformation('0', trigger_tables=['second'], target_table='first')
+    second = _transformation('1', trigger_tables=['first'], target_table='second')
+
+    assert sorted(plan_job([first, second])['order']) == ['0', '1']
+
+
+def test_build_pipeline_dag():
+    root = _transformation('0', trigger_tables=['source'])
+    left = _transformation('1', trigger_tables=['source'], dependencies=[root])
+    right = _transformation('2', trigger_tables=['source'], dependencies=[root])
+    join = _transformation('3', trigger_tables=['source'], dependencies=[root, left, right])
+
+    pipeline = build_pipeline([join, right, left, root])
+    transformations = pipeline[0]['transformations']
+    assert [t['id'] for t in transformations][0] == '0'
+    assert [t['id'] for t in transformations][-1] == '3'
+    assert [t['upstream'] for t in transformations if t['id'] in ('1', '2')] == [['0'], ['0']]
+    assert transformations[-1]['upstream'] == ['0', '1', '2']
+
+
+def test_build_pipeline_lean():
+    first = _transformation('0', trigger_tables=['source'])
+    second = _transformation('1', trigger_tables=['source'], dependencies=[first])
+
+    pipeline = build_pipeline([first, second], lean=True)
+    assert pipeline[0]['transformations'][1]['dependencies'] == ['0']
+    assert pipeline[0]['transformations'][1]['index'] == 1
@@ -0,0 +1,131 @@
+import pytest
+from pymongo import MongoClient
+import bson.json_util
+from nameko.testing.services import worker_factory
+from nameko.containers import ServiceContainer
+from nameko.testing.utils import get_extension
+from application.services.metadata import MetadataService, MetadataServiceError
+from application.services.replica import MetadataReplicaService, MetadataDatabase, Catalog
+
+FUNCTION = 'CREATE FUNCTION my_function (data DOUBLE) RETURN TABLE (result DOUBLE) LANGUAGE PYTHON{}'
+
+
+@pytest.fixture
+def database(db_url):
+    client = MongoClient(db_url)
+
+    yield client['test_db']
+
+    client.drop_database('test_db')
+    client.close()
+
+
+def _load(service):
+    service.add_transformation('0', 'transform', FUNCTION, 'myjob', _input='SELECT * FROM source', target_table='first')
+    service.add_transformation('1', 'transform', FUNCTION, 'myjob', _input='SELECT * FROM first', target_table='second',
+                               depends_on=['0'])
+    service.add_query('0', 'MyQuery', 'SELECT * FROM TOTO')
+    service.add_template('0', 'MyTemplate', 'FR', 'ctx', 'bundle')
+    service.add_template('1', 'OtherTemplate', 'FR', 'ctx', 'bundle')
+    service.handle_suscription({'user': 'admin', 'subscription': {'metadata': {'templates': ['0', '1']}}})
+    service.update_svg_in_template('0', '<svg>{}</svg>'.format('<path d="M0 0"/>' * 1000))
+    service.add_trigger('0', 'MyTrigger', {'type': 'insert', 'source': 'source'}, {'id': '0'}, 'admin',
+                        selector=[{'field': 'value', 'operator': 'gt', 'value': 10}])
+
+
+def test_catalog(database):
+    service = worker_factory(MetadataService, database=database)
+    _load(service)
+
+    catalog = Catalog()
+    assert catalog.ready is False
+    catalog.sync(database)
+    assert catalog.ready is True
+    assert catalog.count()['transformations'] == 2
+    assert [t['id'] for t in catalog.find('templates', 'allowed_users', 'admin')] == ['0', '1']
+    assert [t['id'] for t in catalog.find('transformations', 'trigger_tables', 'first')] == ['1']
+
+    service.delete_template('1')
+    service.add_query('1', 'OtherQuery', 'SELECT * FROM TITI')
+    catalog.sync(database)
+    assert catalog.get('templates', '1') is None
+    assert [t['id'] for t in catalog.find('templates', 'bundle', 'bundle')] == ['0']
+    assert catalog.get('queries', '1')['name'] == 'OtherQuery'
+
+    # A sequence taken by a writer which has not stored its change yet
+    database.counters.update_one({'_id': 'changes'}, {'$inc': {'seq': 1}})
+    service.add_query('2', 'LastQuery', 'SELECT * FROM TUTU')
+    catalog.sync(database)
+    assert catalog.get('queries', '2') is None
+
+    catalog.gap_grace = 0
+    catalog.sync(database)
+    assert catalog.get('queries', '2')['name'] == 'LastQuery'
+
+
+def test_replica_reads(database):
+    service = worker_factory(MetadataService, database=database)
+    _load(service)
+
+    replica = worker_factory(MetadataReplicaService, database=database, catalog=Catalog())
+    with pytest.raises(MetadataServiceError):
+        replica.get_all_templates('admin')
+
+    replica.sync_catalog()
+
+    def same(method, *args, **kwargs):
+        return bson.json_util.loads(getattr(replica, method)(*args, **kwargs)) == \
+            bson.json_util.loads(getattr(service, method)(*args, **kwargs))
+
+    assert same('get_all_transformations')
+    assert same('get_transformation', '1')
+    assert same('get_transformations', ['1', 'other'])
+    assert same('get_query', '0')
+    assert same('get_all_queries')
+    assert same('get_all_templates', 'admin', include_svg=True)
+    assert same('get_templates_by_bundle', 'bundle', 'admin')
+    assert same('get_template', '0', 'admin')
+    assert same('get_template', '0', 'other')
+    assert same('get_templates', ['0', '1'], 'admin')
+    assert same('get_all_triggers')
+    assert same('get_fired_triggers', {'type': 'insert', 'source': 'source'}, payload={'value': 12})
+    assert same('get_fired_triggers', {'type': 'insert', 'source': 'source'}, payload={'value': 2})
+
+    pipeline = bson.json_util.loads(replica.get_update_pipeline('source', lean=True))
+    assert [t['id'] for t in pipeline[0]['transformations']] == ['0', '1']
+    assert pipeline[0]['transformations'][1]['dependencies'] == ['0']
+    assert replica.get_update_pipeline('other') is None
+
+    pipeline = bson.json_util.loads(replica.get_stale_pipeline('source'))
+    assert [t['id'] for t in pipeline[0]['transformations']] == ['0', '1']
+
+    assert replica.get_replica_status()['counts']['templates'] == 2
+
+
+def test_replica_legacy_dependencies(database):
+    database.transformations.insert_many([
+        {'id': 'base', 'job_id': 'myjob', 'trigger_tables': ['source'], 'target_table': 'first', 'depends_on': None},
+        {'id': 'child', 'job_id': 'myjob', 'trigger_tables': ['first'], 'target_table': 'second',
+         'depends_on': 'base'},
+        {'id': 'other', 'job_id': 'otherjob', 'trigger_tables': ['second'], 'target_table': 'third'}
+    ])
+
+    replica = worker_factory(MetadataReplicaService, database=database, catalog=Catalog())
+    replica.sync_catalog()
+
+    pipeline = bson.json_util.loads(replica.get_update_pipeline('source', lean=True))
+    assert [p['job_id'] for p in pipeline] == ['myjob']
+    transformations = {t['id']: t for t in pipeline[0]['transformations']}
+    assert transformations['child']['dependencies'] == ['base']
+
+
+def test_replica_database(db_url):
+    for config, name in (({}, 'metadata'), ({'MONGODB_DB_NAME': 'test_db'}, 'test_db')):
+        container = ServiceContainer(MetadataReplicaService, dict(config, AMQP_URI='memory://',
+                                                                  MONGODB_CONNECTION_URL=db_url))
+        provider = get_extension(container, MetadataDatabase)
+        provider.setup()
+        try:
+            assert provider.db.name == name
+        finally:
+            provider.stop()
@@ -1,9 +1,16 @@
 import datetime
 import pytest
+import eventlet
 from pymongo import MongoClient
 import bson.json_util
 from nameko.testing.services import worker_factory
-from application.services.metadata import MetadataService, MetadataServiceError
+from nameko.containers import ServiceContainer
+from nameko.testing.utils import get_extension
+from nameko.rpc import Rpc
+from nameko.events import EventHandler
+from pymongo.read_preferences import ReadPreference
+from application.services.metadata import MetadataService, MetadataServiceError, SelectorCache, PipelineDebouncer, \
+    ProcessDateBuffer, WorkerLanes, RoutedMongoDatabase, WarmUp, ArchivePolicy, compile_selector, single_flight
 
 
 @pytest.fixture
@@ -35,6 +42,8 @@ def test_add_transformation(database):
     assert trans['materialized'] is False
     assert trans['function_only'] is True
     assert trans['function_name'] == 'my_function'
+    assert 'function' not in trans
+    assert database.functions.find_one({'hash': trans['function_hash']})['function'] == _function
 
     # with pytest.raises(MetadataServiceError):
     #     service.add_transformation(_id, _type, 'foo', job_id)
@@ -63,15 +72,51 @@ def test_add_transformation(database):
     assert trans['materialized'] is True
     assert trans['function_only'] is False
     assert trans['output']
+    assert trans['input_tables'] == ['MYSOURCE']
+
+    service.add_transformation(_id, _type, _function, job_id, _input=_input, target_table=target_table)
+    trans = database.transformations.find_one({'id': _id})
+    assert trans['trigger_tables'] == ['MYSOURCE']
+
+    service.add_transformation(_id, _type, _function, job_id, _input=_input, target_table=target_table,
+                               trigger_tables=['OTHER'])
+    trans = database.transformations.find_one({'id': _id})
+    assert trans['trigger_tables'] == ['MYSOURCE', 'OTHER']
+
+    service.add_transformation(_id, _type, _function, job_id, _input=_input, target_table=target_table,
+                               trigger_tables=['OTHER'], infer_trigger_tables=False)
+    trans = database.transformations.find_one({'id': _id})
+    assert trans['trigger_tables'] == ['OTHER']
 
     with pytest.raises(MetadataServiceError):
         service.add_transformation(_id, _type, _function, job_id, _input='bar', target_table=target_table,
                                    trigger_tables=trigger_tables)
 
-    service.add_transformation(_id, _type, _function, job_id, _input=_input, target_table=target_table,
+    service.add_transformation('1', _type, _function, job_id, _input=_input, target_table=target_table,
                                trigger_tables=trigger_tables, depends_on=_id)
     trans = list(database.transformations.find({'depends_on': _id}))
     assert len(trans) == 1
+    assert trans[0]['depends_on'] == [_id]
+
+    service.add_transformation('2', _type, _function, job_id, _input=_input, target_table=target_table,
+                               depends_on=[_id, '1'])
+    assert database.transformations.find_one({'id': '2'})['depends_on'] == [_id, '1']
+
+    with pytest.raises(MetadataServiceError):
+        service.add_transformation(_id, _type, _function, job_id, _input=_input, target_table=target_table,
+                                   depends_on=_id)
+
+    with pytest.raises(MetadataServiceError):
+        service.add_transformation(_id, _type, _function, job_id, _input=_input, target_table=target_table,
+                                   depends_on=['2'])
+
+    with pytest.raises(MetadataServiceError):
+        service.add_transformation('3', _type, _function, job_id, _input=_input, target_table=target_table,
+                                   depends_on=['1', 'other'])
+
+    with pytest.raises(MetadataServiceError):
+        service.add_transformation('3', _type, _function, 'otherjob', _input=_input, target_table=target_table,
+                                   depends_on=['1'])
 
 
 def test_delete_transformation(database):
@@ -124,6 +169,41 @@ def test_delete_transformation(database):
         service.delete_transformation(_id)
 
 
+def test_delete_transformations(database):
+    service = worker_factory(MetadataService, database=database)
+    database.transformations.insert_many([
+        {'id': '0', 'job_id': 'myjob', 'depends_on': None},
+        {'id': '1', 'job_id': 'myjob', 'depends_on': ['0']},
+        {'id': '2', 'job_id': 'myjob', 'depends_on': ['1', '0']},
+        {'id': '3', 'job_id': 'otherjob', 'depends_on': None}
+    ])
+
+    with pytest.raises(MetadataServiceError):
+        service.delete_transformations(['0', '1'])
+    assert database.transformations.count_documents({}) == 4
+
+    assert service.delete_transformations(['2', '1', 'other']) == {'deleted': {'transformations': ['2', '1']}}
+
+    database.transformations.insert_many([
+        {'id': '1', 'job_id': 'myjob', 'depends_on': ['0']},
+        {'id': '2', 'job_id': 'myjob', 'depends_on': ['1', '0']}
+    ])
+    assert service.delete_transformations(['0'], cascade=True) == {'deleted': {'transformations': ['2', '1', '0']}}
+    assert [t['id'] for t in database.transformations.find()] == ['3']
+
+    assert service.delete_job('otherjob') == {'deleted': {'transformations': ['3']}}
+    assert database.transformations.count_documents({}) == 0
+
+    database.transformations.insert_many([
+        {'id': 'base', 'job_id': 'myjob', 'depends_on': None},
+        {'id': 'child', 'job_id': 'myjob', 'depends_on': 'base'}
+    ])
+    with pytest.raises(MetadataServiceError):
+        service.delete_transformations(['base'])
+    assert service.delete_transformations(['base'], cascade=True) == {
+        'deleted': {'transformations': ['child', 'base']}}
+
+
 def test_update_process_date(database):
     service = worker_factory(MetadataService, database=database)
 
@@ -149,6 +229,56 @@ def test_update_process_date(database):
     assert trans['process_date']
 
 
+def test_update_process_dates(database):
+    service = worker_factory(MetadataService, database=database, process_date_buffer=ProcessDateBuffer(max_size=3))
+    database.transformations.insert_many([
+        {'id': '0', 'target_table': 'first', 'process_date': None},
+        {'id': '1', 'target_table': None, 'process_date': None}
+    ])
+
+    result = service.update_process_dates([
+        {'id': '0', 'finished_at': '2020-01-01T10:00:00', 'duration': 10., 'rows': 100},
+        ('1', '2020-01-01T11:00:00+01:00', 5., 10),
+        {'id': 'other', 'duration': 1.}
+    ])
+    assert result == {'updated': 2}
+
+    trans = database.transformations.find_one({'id': '0'})
+    assert trans['process_date'] == datetime.datetime(2020, 1, 1, 10)
+    assert trans['stats'] == [{'date': datetime.datetime(2020, 1, 1, 10), 'duration': 10., 'rows': 100}]
+    assert database.transformations.find_one({'id': '1'})['process_date'] == datetime.datetime(2020, 1, 1, 10)
+    assert database.tables.find_one({'table': 'first'})['update_date'] == datetime.datetime(2020, 1, 1, 10)
+
+    assert service.update_process_dates([{'id': '0', 'duration': 20.}], write_behind=True) == {'buffered': 1}
+    assert len(database.transformations.find_one({'id': '0'})['stats']) == 1
+
+    service.flush_process_dates()
+    trans = database.transformations.find_one({'id': '0'})
+    assert len(trans['stats']) == 2
+    assert trans['process_date'] > datetime.datetime(2020, 1, 1, 10)
+
+    service.update_process_dates([{'id': '1', 'duration': 1.}] * 3, write_behind=True)
+    assert len(database.transformations.find_one({'id': '1'})['stats']) == 4
+
+    provider = RoutedMongoDatabase()
+    provider.database = database
+    service.process_date_buffer.container = type('Container', (), {'dependencies': [provider]})()
+    service.update_process_dates([{'id': '0', 'duration': 30.}], write_behind=True)
+    service.process_date_buffer.stop()
+    assert len(database.transformations.find_one({'id': '0'})['stats']) == 3
+
+
+def test_update_table_date(database):
+    service = worker_factory(MetadataService, database=database)
+
+    service.update_table_date('source')
+    table = database.tables.find_one({'table': 'source'})
+    assert table['update_date']
+
+    service.update_table_date('source')
+    assert database.tables.find_one({'table': 'source'})['update_date'] >= table['update_date']
+
+
 def test_get_update_pipeline(database):
     service = worker_factory(MetadataService, database=database)
 
@@ -245,6 +375,121 @@ def test_get_update_pipeline(database):
             assert len(p['transformations']) == 1
 
 
+def test_get_update_pipeline_downstream(database):
+    service = worker_factory(MetadataService, database=database)
+    _function = 'CREATE FUNCTION my_function (data DOUBLE) RETURN TABLE (result DOUBLE) LANGUAGE PYTHON{}'
+
+    service.add_transformation('0', 'transform', _function, 'myjob', _input='SELECT * FROM source',
+                               target_table='first')
+    service.add_transformation('1', 'transform', _function, 'myjob', _input='SELECT * FROM first',
+                               target_table='second', depends_on='0')
+    service.add_transformation('2', 'transform', _function, 'otherjob', _input='SELECT * FROM second',
+                               target_table='third')
+    service.add_transformation('3', 'transform', _function, 'otherjob', _input='SELECT * FROM other',
+                               target_table='fourth')
+    service.add_transformation('4', 'transform', _function, 'myjob', _input='SELECT * FROM second',
+                               target_table='fifth')
+
+    # Downstream transformations of other jobs are only triggered by a notification of the table they read
+    pipeline = bson.json_util.loads(service.get_update_pipeline('source'))
+    jobs = {p['job_id']: [t['id'] for t in p['transformations']] for p in pipeline}
+    assert jobs == {'myjob': ['0', '1', '4']}
+    assert pipeline[0]['transformations'][2]['upstream'] == ['1']
+
+    pipeline = bson.json_util.loads(service.get_update_pipeline('second'))
+    jobs = {p['job_id']: [t['id'] for t in p['transformations']] for p in pipeline}
+    assert jobs == {'myjob': ['4'], 'otherjob': ['2']}
+
+
+def test_get_update_pipeline_lean(database):
+    service = worker_factory(MetadataService, database=database)
+    _function = 'CREATE FUNCTION my_function (data DOUBLE) RETURN TABLE (result DOUBLE) LANGUAGE PYTHON{}'
+
+    service.add_transformation('0', 'transform', _function, 'myjob', _input='SELECT * FROM source',
+                               target_table='first')
+    service.add_transformation('1', 'transform', _function, 'myjob', _input='SELECT * FROM first',
+                               target_table='second', depends_on='0')
+
+    pipeline = bson.json_util.loads(service.get_update_pipeline('source', lean=True))
+    transformations = pipeline[0]['transformations']
+    assert [t['id'] for t in transformations] == ['0', '1']
+    assert transformations[1]['dependencies'] == ['0']
+
+
+def test_get_stale_pipeline(database):
+    service = worker_factory(MetadataService, database=database)
+    _function = 'CREATE FUNCTION my_function (data DOUBLE) RETURN TABLE (result DOUBLE) LANGUAGE PYTHON{}'
+
+    service.add_transformation('0', 'transform', _function, 'myjob', _input='SELECT * FROM source',
+                               target_table='first')
+    service.add_transformation('1', 'transform', _function, 'myjob', _input='SELECT * FROM first',
+                               target_table='second', depends_on='0')
+
+    pipeline = bson.json_util.loads(service.get_stale_pipeline('source'))
+    assert [t['id'] for t in pipeline[0]['transformations']] == ['0', '1']
+
+    service.update_table_date('source')
+    service.update_process_date('0')
+    pipeline = bson.json_util.loads(service.get_stale_pipeline('source'))
+    assert [t['id'] for t in pipeline[0]['transformations']] == ['1']
+
+    service.update_process_date('1')
+    assert service.get_stale_pipeline('source') is None
+
+    service.update_table_date('source')
+    pipeline = bson.json_util.loads(service.get_stale_pipeline('source'))
+    assert [t['id'] for t in pipeline[0]['transformations']] == ['0', '1']
+
+
+def test_notify_table_update(database):
+    service = worker_factory(MetadataService, database=database, pipeline_debouncer=PipelineDebouncer(window=60))
+    _function = 'CREATE FUNCTION my_function (data DOUBLE) RETURN TABLE (result DOUBLE) LANGUAGE PYTHON{}'
+
+    service.add_transformation('0', 'transform', _function, 'myjob', _input='SELECT * FROM source',
+                               target_table='first')
+    service.add_transformation('1', 'transform', _function, 'myjob', _input='SELECT * FROM other',
+                               target_table='second')
+    service.dispatch.reset_mock()
+
+    assert service.notify_table_update('source') == {'table': 'source', 'job_ids': ['myjob']}
+    assert service.notify_table_update('source') == {'table': 'source', 'job_ids': ['myjob']}
+    assert service.notify_table_update('other') == {'table': 'other', 'job_ids': ['myjob']}
+    assert database.tables.find_one({'table': 'source'})['update_date']
+
+    service.flush_pipelines()
+    assert service.dispatch.call_count == 0
+
+    assert database.pending_pipelines.count_documents({'job_id': 'myjob'}) == 1
+    database.pending_pipelines.update_one({'job_id': 'myjob'}, {'$set': {'deadline': datetime.datetime(2000, 1, 1)}})
+
+    # The pending window is flushed by any instance, including one started after the notifications
+    restarted = worker_factory(MetadataService, database=database)
+    restarted.flush_pipelines()
+    assert restarted.dispatch.call_count == 1
+
+    service.flush_pipelines()
+    assert service.dispatch.call_count == 0
+
+    event_type, payload = restarted.dispatch.call_args[0]
+    assert event_type == 'job_pipeline'
+    assert payload['tables'] == ['other', 'source']
+    pipeline = bson.json_util.loads(payload['pipeline'])
+    assert sorted(t['id'] for t in pipeline['transformations']) == ['0', '1']
+    assert database.pending_pipelines.count_documents({}) == 0
+
+
+def test_extract_tables():
+    assert MetadataService._extract_tables('SELECT * FROM MYSOURCE') == ['MYSOURCE']
+    assert MetadataService._extract_tables(
+        'SELECT a.x FROM s.t1 a JOIN t2 b ON a.id = b.id LEFT JOIN (SELECT * FROM t3) c ON 1 = 1 '
+        'WHERE x IN (SELECT y FROM t4)') == ['s.t1', 't2', 't3', 't4']
+    assert MetadataService._extract_tables(
+        'WITH w AS (SELECT * FROM t5) SELECT * FROM w, t6 x') == ['t5', 't6']
+    assert MetadataService._extract_tables('SELECT * FROM f((SELECT * FROM t7))') == ['t7']
+    assert MetadataService._extract_tables(
+        'SELECT * FROM source s JOIN first f ON s.id = f.id') == ['source', 'first']
+
+
 def test_get_all_transformations(database):
     service = worker_factory(MetadataService, database=database)
     result = bson.json_util.loads(service.get_all_transformations())
@@ -289,6 +534,39 @@ def test_get_transformation(database):
     assert result['id'] == '0'
 
 
+def test_get_transformations(database):
+    service = worker_factory(MetadataService, database=database)
+    database.transformations.insert_many([
+        {'id': '0', 'type': 'transform', 'job_id': 'myjob'},
+        {'id': '1', 'type': 'transform', 'job_id': 'myjob'}
+    ])
+
+    result = bson.json_util.loads(service.get_transformations(['1', 'other', '0']))
+    assert [r['id'] for r in result['results']] == ['1', '0']
+    assert result['missing'] == ['other']
+
+
+def test_get_functions(database):
+    service = worker_factory(MetadataService, database=database)
+    _function = 'CREATE FUNCTION my_function (data DOUBLE) RETURN TABLE (result DOUBLE) LANGUAGE PYTHON{}'
+
+    service.add_transformation('0', 'transform', _function, 'myjob')
+    service.add_transformation('1', 'transform', _function, 'otherjob')
+    assert database.functions.count_documents({}) == 1
+
+    function_hash = database.transformations.find_one({'id': '0'})['function_hash']
+    result = bson.json_util.loads(service.get_functions([function_hash, 'other']))
+    assert result['results'][0]['function'] == _function
+    assert result['results'][0]['function_name'] == 'my_function'
+    assert result['missing'] == ['other']
+
+    result = bson.json_util.loads(service.get_transformation('1'))
+    assert result['function'] == _function
+
+    result = bson.json_util.loads(service.get_transformations(['0']))
+    assert result['results'][0]['function'] == _function
+
+
 def test_add_query(database):
     service = worker_factory(MetadataService, database=database)
     service.add_query('0', 'MyQuery', 'SELECT * FROM TOTO')
@@ -298,9 +576,22 @@ def test_add_query(database):
     assert doc['creation_date']
     assert doc['id'] == '0'
 
+    assert service.add_query('0', 'MyQuery', 'SELECT * FROM TOTO') == {'id': '0', 'changed': False}
+    assert database.queries.find_one({'id': '0'})['creation_date'] == doc['creation_date']
+
+    assert service.add_query('0', 'MyQuery', 'SELECT * FROM TITI') == {'id': '0', 'changed': True}
+    assert service.dispatch.call_count == 2
+
     with pytest.raises(MetadataServiceError):
         service.add_query('0', 'MyQuery', 'foo')
 
+    sql = 'SELECT {} FROM TOTO'.format(', '.join('COLUMN_{}'.format(i) for i in range(1000)))
+    service.add_query('1', 'MyLargeQuery', sql)
+    assert isinstance(database.queries.find_one({'id': '1'})['sql'], bytes)
+    assert bson.json_util.loads(service.get_query('1'))['sql'] == sql
+    assert bson.json_util.loads(service.get_queries(['1']))['results'][0]['sql'] == sql
+    assert service.add_query('1', 'MyLargeQuery', sql)['changed'] is False
+
 
 def test_delete_query(database):
     service = worker_factory(MetadataService, database=database)
@@ -331,6 +622,23 @@ def test_delete_query(database):
     with pytest.raises(MetadataServiceError):
         service.delete_query('1')
 
+
+def test_delete_queries(database):
+    service = worker_factory(MetadataService, database=database)
+    database.queries.insert_many([{'id': '0'}, {'id': '1'}, {'id': '2'}])
+    database.templates.insert_one({'id': '0', 'queries': [{'id': '0'}, {'id': '2'}]})
+
+    with pytest.raises(MetadataServiceError):
+        service.delete_queries(['0', '1'])
+
+    assert service.delete_queries(['1']) == {'deleted': {'queries': ['1']}, 'updated': {'templates': []}}
+
+    assert service.delete_queries(['0', '1'], cascade=True) == {'deleted': {'queries': ['0']},
+                                                                'updated': {'templates': ['0']}}
+    assert database.templates.find_one({'id': '0'})['queries'] == [{'id': '2'}]
+    assert [q['id'] for q in database.queries.find()] == ['2']
+
+
 def test_get_all_queries(database):
     service = worker_factory(MetadataService, database=database)
     database.queries.insert_one({
@@ -357,6 +665,18 @@ def test_get_query(database):
     assert result['id'] == '0'
 
 
+def test_get_queries(database):
+    service = worker_factory(MetadataService, database=database)
+    database.queries.insert_many([
+        {'id': '0', 'name': 'MyQuery', 'sql': 'SELECT * FROM TOTO', 'parameters': None},
+        {'id': '1', 'name': 'MyQuery', 'sql': 'SELECT * FROM TOTO', 'parameters': None}
+    ])
+
+    result = bson.json_util.loads(service.get_queries(['1', '0', '1']))
+    assert [r['id'] for r in result['results']] == ['1', '0']
+    assert result['missing'] == []
+
+
 def test_add_template(database):
     service = worker_factory(MetadataService, database=database)
     service.add_template('0', 'MyTemplate', 'FR', 'ctx', 'bundle', {'format': 'myFormat'})
@@ -370,6 +690,9 @@ def test_add_template(database):
     doc = database.templates.find_one({'id': '1'})
     assert doc['picture'] is None
 
+    assert service.add_template('1', 'MyTemplate', 'FR', 'ctx', 'bundle')['changed'] is False
+    assert service.add_template('1', 'MyTemplate', 'EN', 'ctx', 'bundle')['changed'] is True
+
 
 def test_delete_template(database):
     service = worker_factory(MetadataService, database=database)
@@ -398,6 +721,20 @@ def test_delete_template(database):
         service.delete_template('1')
 
 
+def test_delete_templates(database):
+    service = worker_factory(MetadataService, database=database)
+    database.templates.insert_many([{'id': '0'}, {'id': '1'}])
+    database.triggers.insert_one({'id': '0', 'template': {'id': '0'}})
+
+    with pytest.raises(MetadataServiceError):
+        service.delete_templates(['0', '1'])
+
+    assert service.delete_templates(['0', '1'], cascade=True) == {'deleted': {'triggers': ['0'],
+                                                                              'templates': ['0', '1']}}
+    assert database.templates.count_documents({}) == 0
+    assert database.triggers.count_documents({}) == 0
+
+
 def test_get_all_templates(database):
     service = worker_factory(MetadataService, database=database)
     database.templates.insert_one({
@@ -422,6 +759,41 @@ def test_get_all_templates(database):
     assert 'svg' in result[0]
 
 
+def test_single_flight():
+    calls = []
+
+    class Reader(object):
+        @single_flight
+        def read(self, key):
+            calls.append(key)
+            eventlet.sleep(0.01)
+            if key == 'error':
+                raise MetadataServiceError('Failed read')
+            return 'result {}'.format(key)
+
+    reader = Reader()
+    threads = [eventlet.spawn(reader.read, key) for key in ('a', 'a', 'a', 'b')]
+    assert [t.wait() for t in threads] == ['result a', 'result a', 'result a', 'result b']
+    assert calls == ['a', 'b']
+
+    assert reader.read('a') == 'result a'
+    assert calls == ['a', 'b', 'a']
+
+    threads = [eventlet.spawn(reader.read, 'error') for _ in range(2)]
+    for t in threads:
+        with pytest.raises(MetadataServiceError):
+            t.wait()
+    assert calls.count('error') == 1
+
+    owner = eventlet.spawn(reader.read, 'killed')
+    eventlet.sleep(0)
+    waiter = eventlet.spawn(reader.read, 'killed')
+    eventlet.sleep(0)
+    owner.kill()
+    with pytest.raises(MetadataServiceError):
+        waiter.wait()
+
+
 def test_get_templates_by_bundle(database):
     service = worker_factory(MetadataService, database=database)
     database.templates.insert_one({
@@ -458,6 +830,18 @@ def test_get_template(database):
     assert not result
 
 
+def test_get_templates(database):
+    service = worker_factory(MetadataService, database=database)
+    database.templates.insert_many([
+        {'id': '0', 'name': 'MyQuery', 'allowed_users': ['admin']},
+        {'id': '1', 'name': 'MyQuery', 'allowed_users': ['other']}
+    ])
+
+    result = bson.json_util.loads(service.get_templates(['0', '1'], 'admin'))
+    assert [r['id'] for r in result['results']] == ['0']
+    assert result['missing'] == ['1']
+
+
 def test_add_query_to_template(database):
     service = worker_factory(MetadataService, database=database)
     database.templates.insert_one({
@@ -485,6 +869,15 @@ def test_add_query_to_template(database):
     assert len(res['queries']) == 1
     assert res['queries'][0]['labels']
 
+    service.add_query_to_template('0', '0', limit=10)
+    res = database.templates.find_one({'id': '0'})
+    assert len(res['queries']) == 1
+    assert res['queries'][0]['limit'] == 10
+    assert 'limit' not in res
+
+    with pytest.raises(MetadataServiceError):
+        service.add_query_to_template('1', '0')
+
     with pytest.raises(MetadataServiceError):
         service.add_query_to_template('0', '1', referential_parameters=[{'titi': 'toto'}])
 
@@ -492,6 +885,45 @@ def test_add_query_to_template(database):
         service.add_query_to_template('0', '0', referential_parameters=[{'tutu': 'toto'}])
 
 
+def test_set_template_queries(database):
+    service = worker_factory(MetadataService, database=database)
+    database.templates.insert_one({
+        'id': '0',
+        'name': 'MyQuery',
+        'language': 'FR',
+        'context': 'ctx',
+        'queries': [{'id': '0', 'limit': 50}, {'id': '1', 'limit': 50}]
+    })
+
+    database.queries.insert_many([
+        {'id': '0', 'name': 'MyQuery', 'sql': 'SELECT * FROM TOTO', 'parameters': None},
+        {'id': '1', 'name': 'MyQuery', 'sql': 'SELECT * FROM TOTO', 'parameters': None},
+        {'id': '2', 'name': 'MyQuery', 'sql': 'SELECT * FROM TOTO WHERE TITI = %s', 'parameters': ['titi']}
+    ])
+
+    service.set_template_queries('0', [{'id': '1', 'limit': 10}, {'id': '2'}], merge=True)
+    res = database.templates.find_one({'id': '0'})
+    assert [q['id'] for q in res['queries']] == ['0', '1', '2']
+    assert res['queries'][1]['limit'] == 10
+    assert res['queries'][2]['limit'] == 50
+
+    service.set_template_queries('0', [{'id': '2', 'referential_parameters': [{'titi': 'toto'}]}])
+    res = database.templates.find_one({'id': '0'})
+    assert [q['id'] for q in res['queries']] == ['2']
+
+    with pytest.raises(MetadataServiceError):
+        service.set_template_queries('0', [{'id': '3'}])
+
+    with pytest.raises(MetadataServiceError):
+        service.set_template_queries('0', [{'id': '0', 'limits': 10}])
+
+    with pytest.raises(MetadataServiceError):
+        service.set_template_queries('0', [{'id': '0', 'referential_parameters': [{'titi': 'toto'}]}])
+
+    with pytest.raises(MetadataServiceError):
+        service.set_template_queries('1', [{'id': '0'}])
+
+
 def test_delete_query_from_template(database):
     service = worker_factory(MetadataService, database=database)
     database.templates.insert_one({
@@ -522,6 +954,14 @@ def test_update_svg_in_template(database):
     res = database.templates.find_one({'id': '0'})
     assert res['svg'] == '<svg>toto</svg>'
 
+    svg = '<svg>{}</svg>'.format('<path d="M0 0"/>' * 1000)
+    service.update_svg_in_template('0', svg)
+    res = database.templates.find_one({'id': '0'})
+    assert isinstance(res['svg'], bytes)
+    database.templates.update_one({'id': '0'}, {'$set': {'allowed_users': ['admin']}})
+    assert bson.json_util.loads(service.get_template('0', 'admin'))['svg'] == svg
+    assert bson.json_util.loads(service.get_all_templates('admin', include_svg=True))[0]['svg'] == svg
+
 
 def test_update_html_in_template(database):
     service = worker_factory(MetadataService, database=database)
@@ -558,6 +998,10 @@ def test_add_trigger(database):
     with pytest.raises(MetadataServiceError):
         service.add_trigger('2', 'MyName', 'event', {'id': '0'}, 'bar')
 
+    service = worker_factory(MetadataService, database=database, selectors=SelectorCache())
+    with pytest.raises(MetadataServiceError):
+        service.add_trigger('3', 'MyName', 'event', {'id': '0'}, 'foo', selector=[{'field': 'a', 'operator': 'foo'}])
+
 
 def test_delete_trigger(database):
     service = worker_factory(MetadataService, database=database)
@@ -579,6 +1023,18 @@ def test_get_trigger(database):
     assert trigger['id'] == '0'
 
 
+def test_get_triggers(database):
+    service = worker_factory(MetadataService, database=database)
+    database.triggers.insert_many([
+        {'id': '0', 'on_event': 'event'},
+        {'id': '1', 'on_event': 'event'}
+    ])
+
+    result = bson.json_util.loads(service.get_triggers(['1', '2', '0']))
+    assert [r['id'] for r in result['results']] == ['1', '0']
+    assert result['missing'] == ['2']
+
+
 def test_get_all_triggers(database):
     service = worker_factory(MetadataService, database=database)
     database.triggers.insert_one({
@@ -600,6 +1056,55 @@ def test_get_fired_triggers(database):
     assert len(triggers) == 1
     assert triggers[0]['id'] == '0'
 
+    service = worker_factory(MetadataService, database=database, selectors=SelectorCache())
+    database.triggers.insert_one({
+        'id': '1',
+        'on_event': {'type': 'foo', 'source': 'bar'},
+        'selector': [{'field': 'team.id', 'operator': 'in', 'value': ['a', 'b']}]
+    })
+    triggers = bson.json_util.loads(service.get_fired_triggers({'type': 'foo', 'source': 'bar'},
+                                                               payload={'team': {'id': 'c'}}))
+    assert [t['id'] for t in triggers] == ['0']
+
+    triggers = bson.json_util.loads(service.get_fired_triggers({'type': 'foo', 'source': 'bar'},
+                                                               payload={'team': {'id': 'a'}}))
+    assert sorted(t['id'] for t in triggers) == ['0', '1']
+
+    database.triggers.insert_many([
+        {'id': '2', 'on_event': {'type': 'foo', 'source': 'bar'}, 'selector': {'team.id': 'a'}},
+        {'id': '3', 'on_event': {'type': 'foo', 'source': 'bar'},
+         'selector': [{'field': 'team.id', 'operator': 'in', 'value': 5}]}
+    ])
+    triggers = bson.json_util.loads(service.get_fired_triggers({'type': 'foo', 'source': 'bar'},
+                                                               payload={'team': {'id': 'a'}}))
+    assert sorted(t['id'] for t in triggers) == ['0', '1']
+
+
+def test_compile_selector():
+    assert compile_selector([])({})
+    assert compile_selector(None)({'foo': 'bar'})
+
+    predicate = compile_selector([
+        {'field': 'score.home', 'operator': 'gte', 'value': 2},
+        {'field': 'competition', 'value': 'L1'},
+        {'field': 'name', 'operator': 'regex', 'value': '^PSG'},
+        {'field': 'cancelled', 'operator': 'exists', 'value': False}
+    ])
+    assert predicate({'score': {'home': 3}, 'competition': 'L1', 'name': 'PSG-OM'})
+    assert not predicate({'score': {'home': 1}, 'competition': 'L1', 'name': 'PSG-OM'})
+    assert not predicate({'score': {'home': 'foo'}, 'competition': 'L1', 'name': 'PSG-OM'})
+    assert not predicate({'competition': 'L1', 'name': 'PSG-OM'})
+    assert not predicate({'score': {'home': 3}, 'competition': 'L1', 'name': 'PSG-OM', 'cancelled': True})
+
+    with pytest.raises(MetadataServiceError):
+        compile_selector([{'operator': 'eq', 'value': 1}])
+
+    with pytest.raises(MetadataServiceError):
+        compile_selector([{'field': 'name', 'operator': 'regex', 'value': '('}])
+
+    with pytest.raises(MetadataServiceError):
+        compile_selector([{'field': 'name', 'operator': 'in', 'value': 5}])
+
 
 def test_handle_subscription(database):
     service = worker_factory(MetadataService, database=database)
@@ -639,4 +1144,234 @@ def test_handle_subscription(database):
     assert t['allowed_users'] == []
 
     s = database.subscriptions.find_one({'user': 'foo'})
-    assert s['subscription']['templates'] == ['1']
\ No newline at end of file
+    assert s['subscription']['templates'] == ['1']
+
+
+def test_get_changes_since(database):
+    service = worker_factory(MetadataService, database=database)
+    service.add_query('0', 'MyQuery', 'SELECT * FROM TOTO')
+    service.add_query('1', 'MyQuery', 'SELECT * FROM TOTO')
+    service.delete_query('0')
+
+    assert service.dispatch.call_count == 3
+    assert service.dispatch.call_args[0] == ('metadata_change', {
+        'seq': 3, 'collection': 'queries', 'id': '0', 'op': 'delete', 'fields': None})
+
+    result = bson.json_util.loads(service.get_changes_since(0))
+    assert [(c['seq'], c['id'], c['op']) for c in result['changes']] == [(1, '0', 'upsert'), (2, '1', 'upsert'),
+                                                                         (3, '0', 'delete')]
+    assert 'sql' in result['changes'][0]['fields']
+    assert result['last_seq'] == 3
+    assert result['reset'] is False
+
+    result = bson.json_util.loads(service.get_changes_since(2))
+    assert [c['seq'] for c in result['changes']] == [3]
+
+    result = bson.json_util.loads(service.get_changes_since(5))
+    assert result['changes'] == []
+    assert result['reset'] is True
+
+    database.counters.update_one({'_id': 'changes'}, {'$inc': {'seq': 1}})
+    service.add_query('2', 'MyQuery', 'SELECT * FROM TOTO')
+
+    result = bson.json_util.loads(service.get_changes_since(2))
+    assert [c['seq'] for c in result['changes']] == [3]
+    assert 'date' not in result['changes'][0]
+    result = bson.json_util.loads(service.get_changes_since(3))
+    assert result['changes'] == []
+    assert result['reset'] is False
+
+    service.CHANGE_GAP_GRACE = 0
+    result = bson.json_util.loads(service.get_changes_since(3))
+    assert result['changes'] == []
+    assert result['reset'] is True
+
+
+def test_worker_lanes(database):
+    lanes = WorkerLanes(lanes={'heavy': {'size': 1, 'max_waiting': 1}, 'write': {'size': 1, 'max_waiting': None},
+                               'light': {'size': None, 'max_waiting': None}})
+    service = worker_factory(MetadataService, database=database, worker_lanes=lanes)
+
+    def hold(lane, event):
+        with lanes.acquire(lane):
+            event.wait()
+
+    release = eventlet.event.Event()
+    running = eventlet.spawn(hold, 'heavy', release)
+    waiting = eventlet.spawn(hold, 'heavy', release)
+    eventlet.sleep(0)
+
+    stats = service.get_lane_stats()
+    assert stats['heavy']['active'] == 1
+    assert stats['heavy']['waiting'] == 1
+
+    with pytest.raises(MetadataServiceError):
+        service.get_update_pipeline('source')
+    assert service.get_lane_stats()['heavy']['rejected'] == 1
+
+    assert service.update_process_dates([]) == {'updated': 0}
+    assert service.get_lane_stats()['write']['completed'] == 1
+
+    service.get_template('0', 'admin')
+    assert service.get_lane_stats()['light']['completed'] == 1
+
+    release.send()
+    running.wait()
+    waiting.wait()
+
+    stats = service.get_lane_stats()
+    assert stats['heavy']['active'] == 0
+    assert stats['heavy']['completed'] == 2
+    assert stats['heavy']['peak_waiting'] == 1
+
+    with pytest.raises(MetadataServiceError):
+        with lanes.acquire('other'):
+            pass
+
+    container = ServiceContainer(MetadataService, {'AMQP_URI': 'memory://', 'WORKER_LANES': {
+        'heavy': {'max_waiting': 2}, 'light': {'size': None, 'max_waiting': None}}})
+    lanes = get_extension(container, WorkerLanes)
+    lanes.setup()
+    stats = lanes.get_stats()
+    assert (stats['heavy']['size'], stats['heavy']['max_waiting']) == (4, 2)
+    assert stats['background']['size'] == 2
+    with lanes.acquire('background'):
+        pass
+
+
+def test_background_lane(database):
+    lanes = WorkerLanes(lanes={'background': {'size': 1, 'max_waiting': None}})
+    service = worker_factory(MetadataService, database=database, worker_lanes=lanes)
+    database.templates.insert_many([{'id': 'a', 'allowed_users': []}, {'id': 'b', 'allowed_users': []}])
+
+    container = ServiceContainer(MetadataService, {'AMQP_URI': 'memory://'})
+    assert get_extension(container, EventHandler, method_name='handle_suscription').requeue_on_error is False
+
+    def hold(event):
+        with lanes.acquire('background'):
+            event.wait()
+
+    release = eventlet.event.Event()
+    running = eventlet.spawn(hold, release)
+    eventlet.sleep(0)
+
+    # Subscriptions wait for the lane in their arrival order instead of being rejected
+    threads = [eventlet.spawn(service.handle_suscription, {'user': 'foo', 'subscription': {'metadata': {
+        'templates': templates}}}) for templates in (['a', 'b'], ['a'])]
+    eventlet.sleep(0)
+    assert service.get_lane_stats()['background']['waiting'] == 2
+    assert database.subscriptions.find_one({'user': 'foo'}) is None
+
+    release.send()
+    running.wait()
+    for t in threads:
+        t.wait()
+
+    assert database.subscriptions.find_one({'user': 'foo'})['subscription'] == {'templates': ['a']}
+    assert database.templates.find_one({'id': 'b'})['allowed_users'] == []
+
+
+def test_routed_database(db_url, database):
+    config = {'AMQP_URI': 'memory://', 'MONGODB_CONNECTION_URL': db_url, 'MONGODB_DB_NAME': 'test_db',
+              'MONGODB_READ_PREFERENCE': 'secondaryPreferred', 'MONGODB_MAX_STALENESS': 120}
+    container = ServiceContainer(MetadataService, config)
+    provider = get_extension(container, RoutedMongoDatabase)
+    provider.setup()
+    assert 'changes' in provider.db.list_collection_names()
+
+    def worker_ctx(method_name):
+        entrypoint = get_extension(container, Rpc, method_name=method_name)
+        return type('WorkerContext', (), {'entrypoint': entrypoint})()
+
+    try:
+        database = provider.get_dependency(worker_ctx('get_template'))
+        assert database.read_preference.mode == ReadPreference.SECONDARY_PREFERRED.mode
+        assert database.read_preference.max_staleness == 120
+
+        for method_name in ('add_template', 'get_update_pipeline', 'get_changes_since'):
+            database = provider.get_dependency(worker_ctx(method_name))
+            assert database.read_preference.mode == ReadPreference.PRIMARY.mode
+    finally:
+        provider.stop()
+
+
+def test_warm_up(database):
+    warm_up = WarmUp()
+    selectors = SelectorCache()
+    service = worker_factory(MetadataService, database=database, warm_up=warm_up, selectors=selectors)
+    assert service.get_readiness() == {'ready': False}
+
+    database.templates.insert_many([
+        {'id': '0', 'name': 'MyTemplate', 'allowed_users': ['admin', 'other']},
+        {'id': '1', 'name': 'OtherTemplate', 'allowed_users': ['admin']}
+    ])
+    database.triggers.insert_many([
+        {'id': '0', 'selector': [{'field': 'value', 'operator': 'gt', 'value': 10}]},
+        {'id': '1', 'selector': [{'field': 'value', 'operator': 'foo'}]}
+    ])
+    database.transformations.insert_one({'id': '0', 'job_id': 'myjob'})
+
+    warm_up.warm(database, selectors)
+
+    report = service.get_readiness()
+    assert report['ready'] is True
+    assert report['documents'] == {'templates': 3, 'triggers': 2, 'transformations': 1}
+    assert report['duration'] >= 0
+    assert report['memory']['after'] >= report['memory']['before']
+    assert len(selectors.compiled) == 1
+
+    warm_up.warm(database.client['test_primary_db'], selectors, read_database=database)
+    assert service.get_readiness()['documents'] == {'templates': 3, 'triggers': 2, 'transformations': 0}
+
+
+def test_archive_stale_metadata(database):
+    service = worker_factory(MetadataService, database=database, archive_policy=ArchivePolicy(after_days=30))
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=60)
+    recent = datetime.datetime.utcnow()
+
+    database.transformations.insert_many([
+        {'id': '0', 'process_date': old, 'function_hash': 'a'},
+        {'id': '1', 'process_date': old, 'depends_on': ['0'], 'function_hash': 'a'},
+        {'id': 'base', 'process_date': old},
+        {'id': '3', 'process_date': recent, 'depends_on': 'base'},
+        {'id': '4', 'process_date': None, 'creation_date': recent, 'function_hash': 'b'},
+        {'id': '5', 'process_date': None, 'creation_date': old, 'function_only': True},
+        {'id': 'producer', 'process_date': old, 'target_table': 'sixth'},
+        {'id': '7', 'process_date': recent, 'trigger_tables': ['sixth']}
+    ])
+    database.functions.insert_many([
+        {'hash': 'a', 'creation_date': old},
+        {'hash': 'b', 'creation_date': old}
+    ])
+    database.queries.insert_many([
+        {'id': '0', 'creation_date': old},
+        {'id': '1', 'creation_date': old},
+        {'id': '2', 'creation_date': recent}
+    ])
+    database.templates.insert_one({'id': '0', 'queries': [{'id': '1'}]})
+    database.triggers.insert_many([
+        {'id': '0', 'template': {'id': '0'}},
+        {'id': '1', 'template': {'id': 'deleted'}}
+    ])
+
+    expected = {'transformations': [], 'functions': [], 'queries': ['0'], 'triggers': ['1']}
+    assert service.archive_stale_metadata(dry_run=True) == expected
+
+    service.archive_policy.transformations_after_days = 30
+    expected = {'transformations': ['0', '1'], 'functions': ['a'], 'queries': ['0'], 'triggers': ['1']}
+    assert service.archive_stale_metadata(dry_run=True) == expected
+    assert database.archive_transformations.count_documents({}) == 0
+
+    assert service.archive_stale_metadata() == {'transformations': 2, 'functions': 1, 'queries': 1, 'triggers': 1}
+    assert sorted(t['id'] for t in database.transformations.find()) == ['3', '4', '5', '7', 'base', 'producer']
+    assert sorted(t['id'] for t in database.archive_transformations.find()) == ['0', '1']
+    assert database.archive_queries.find_one({'id': '0'})['archive_date']
+    assert database.archive_functions.find_one({'hash': 'a'})
+    assert not database.triggers.find_one({'id': '1'})
+
+    changes = bson.json_util.loads(service.get_changes_since(0))['changes']
+    assert [(c['collection'], c['id']) for c in changes if c['op'] == 'delete'] == [
+        ('transformations', '0'), ('transformations', '1'), ('functions', 'a'), ('queries', '0'), ('triggers', '1')]
+
+    assert service.archive_stale_metadata() == {'transformations': 0, 'functions': 0, 'queries': 0, 'triggers': 0}
+
@@ -0,0 +1,52 @@
+import pytest
+from pymongo import MongoClient
+from nameko.testing.services import worker_factory
+from application.services.metadata import MetadataService
+from application.snapshot import export_snapshot, import_snapshot
+
+
+@pytest.fixture
+def client(db_url):
+    client = MongoClient(db_url)
+
+    yield client
+
+    client.drop_database('test_db')
+    client.drop_database('test_restore_db')
+    client.close()
+
+
+def test_snapshot(client, tmp_path):
+    database = client['test_db']
+    service = worker_factory(MetadataService, database=database)
+    service.add_transformation('0', 'transform', 'CREATE FUNCTION my_function (data DOUBLE) RETURN TABLE '
+                               '(result DOUBLE) LANGUAGE PYTHON{}', 'myjob', _input='SELECT * FROM source',
+                               target_table='first')
+    service.add_query('0', 'MyQuery', 'SELECT {} FROM TOTO'.format(', '.join('C{}'.format(i) for i in range(1000))))
+    service.add_template('0', 'MyTemplate', 'FR', 'ctx', 'bundle')
+    service.update_process_dates([{'id': '0', 'duration': 2.}])
+
+    path = str(tmp_path / 'snapshot.bson.gz')
+    counts = export_snapshot(database, path)
+    assert counts['transformations'] == 1
+    assert counts['queries'] == 1
+
+    restored = client['test_restore_db']
+    assert import_snapshot(restored, path, batch_size=2) == counts
+
+    for name in counts:
+        assert list(restored[name].find()) == list(database[name].find())
+        assert sorted(restored[name].index_information()) == sorted(database[name].index_information())
+
+    with pytest.raises(ValueError):
+        import_snapshot(restored, path)
+
+    assert import_snapshot(restored, path, drop=True) == counts
+
+    client.drop_database('test_restore_db')
+    first, last = sorted(counts)[0], sorted(counts)[-1]
+    restored[last].insert_one({'id': 'other'})
+    with pytest.raises(ValueError):
+        import_snapshot(restored, path)
+    assert restored.list_collection_names() == [last]
+    assert restored[first].estimated_document_count() == 0
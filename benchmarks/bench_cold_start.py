@@ -0,0 +1,89 @@
+"""Cold start of the metadata service: import time and container start time by component.
+
+Imports are measured in fresh interpreters with -X importtime and grouped by top level package. The container is
+then built in process and each of its extensions is set up and started on its own. The benchmark fails when the
+median import time of the service exceeds the target.
+
+    python -m benchmarks.bench_cold_start [--db-url mongodb://localhost:27017] [--repeat 5] [--target-ms 600]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+MODULE = 'application.services.metadata'
+
+
+def _import_times(module):
+    # Self times of every imported module summed by top level package, plus the total wall time of the import
+    code = 'import time; start = time.perf_counter(); import {}; print(time.perf_counter() - start)'.format(module)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    components = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, _, name = line[len('import time:'):].split('|')
+        component = name.strip().split('.')[0]
+        components[component] = components.get(component, 0.) + int(self_time) / 1000.
+
+    return float(result.stdout.strip().splitlines()[-1]) * 1000., components
+
+
+def _start_times(db_url):
+    # Patched before nameko is imported in this process, as nameko run does
+    import eventlet
+    eventlet.monkey_patch()
+
+    from nameko.containers import ServiceContainer
+    from application.services.metadata import MetadataService
+
+    config = {'AMQP_URI': 'memory://', 'MONGODB_CONNECTION_URL': db_url}
+    container = ServiceContainer(MetadataService, config)
+
+    components = {}
+    try:
+        for step in ('setup', 'start'):
+            for extension in container.extensions:
+                start = time.perf_counter()
+                getattr(extension, step)()
+                name = type(extension).__name__
+                components[name] = components.get(name, 0.) + (time.perf_counter() - start) * 1000.
+    finally:
+        container.kill()
+
+    return components
+
+
+def _print(title, components, limit=15):
+    print(title)
+    for name, elapsed in sorted(components.items(), key=lambda c: -c[1])[:limit]:
+        print('    {:<30} {:>10.2f} ms'.format(name, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db-url', default='mongodb://localhost:27017')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--target-ms', type=float, default=600.)
+    parser.add_argument('--skip-container', action='store_true')
+    args = parser.parse_args()
+
+    runs = [_import_times(MODULE) for _ in range(args.repeat)]
+    median = statistics.median(r[0] for r in runs)
+    components = {name: statistics.median(r[1].get(name, 0.) for r in runs) for name in runs[0][1]}
+
+    _print('Import of {} (median of {} runs): {:.2f} ms'.format(MODULE, args.repeat, median), components)
+
+    if not args.skip_container:
+        _print('Container setup and start', _start_times(args.db_url))
+
+    if median > args.target_ms:
+        print('Cold import {:.2f} ms exceeds the {:.2f} ms target'.format(median, args.target_ms))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
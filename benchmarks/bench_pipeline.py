@@ -0,0 +1,97 @@
+"""Payload size and latency of get_update_pipeline with respect to the depth of a chain of transformations.
+
+Without --db-url the benchmark plans synthetic chains in process, embedding ancestors the way $graphLookup does for
+the default mode. With --db-url it loads the chains in a scratch database and calls the RPC itself.
+
+    python -m benchmarks.bench_pipeline [--db-url mongodb://localhost:27017] [--depths 5,10,50,100]
+"""
+import argparse
+import time
+
+import bson.json_util
+
+from application.services.pipeline import build_pipeline, get_ancestors
+
+FUNCTION = 'CREATE FUNCTION my_function (data DOUBLE) RETURN TABLE (result DOUBLE) LANGUAGE PYTHON {{{}}}'.format(
+    '\n    result = data * 2' * 64)
+
+
+def _chain(depth):
+    return [{
+        'id': str(i),
+        'job_id': 'benchjob',
+        'type': 'transform',
+        'function': FUNCTION,
+        'function_name': 'my_function',
+        'input': 'SELECT * FROM {}'.format('source' if i == 0 else 'table_{}'.format(i - 1)),
+        'trigger_tables': ['source' if i == 0 else 'table_{}'.format(i - 1)],
+        'target_table': 'table_{}'.format(i),
+        'depends_on': [str(i - 1)] if i != 0 else None,
+        'process_date': None
+    } for i in range(depth)]
+
+
+def _plan_in_process(depth, lean):
+    transformations = _chain(depth)
+    by_id = {t['id']: t for t in _chain(depth)}
+    ancestors = get_ancestors(transformations)
+
+    start = time.perf_counter()
+    for t in transformations:
+        if lean:
+            t['dependencies'] = [{'id': a, 'process_date': by_id[a]['process_date']} for a in ancestors[t['id']]]
+        else:
+            t['dependencies'] = [dict(by_id[a]) for a in ancestors[t['id']]]
+    payload = bson.json_util.dumps(build_pipeline(transformations, lean=lean))
+
+    return len(payload), time.perf_counter() - start
+
+
+def _plan_with_rpc(database, depth, lean):
+    from nameko.testing.services import worker_factory
+    from application.services.metadata import MetadataService
+
+    service = worker_factory(MetadataService, database=database)
+    database.transformations.delete_many({})
+    database.transformations.insert_many(_chain(depth))
+
+    start = time.perf_counter()
+    payload = service.get_update_pipeline('source', lean=lean)
+
+    return len(payload), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db-url', default=None)
+    parser.add_argument('--depths', default='5,10,20,50,100,200')
+    args = parser.parse_args()
+
+    depths = [int(d) for d in args.depths.split(',')]
+
+    client = None
+    if args.db_url is not None:
+        from pymongo import MongoClient
+        client = MongoClient(args.db_url)
+        database = client['bench_pipeline']
+
+        def plan(depth, lean):
+            return _plan_with_rpc(database, depth, lean)
+    else:
+        plan = _plan_in_process
+
+    print('{:>6} {:>14} {:>12} {:>14} {:>12}'.format('depth', 'full bytes', 'full ms', 'lean bytes', 'lean ms'))
+    try:
+        for depth in depths:
+            full_size, full_elapsed = plan(depth, False)
+            lean_size, lean_elapsed = plan(depth, True)
+            print('{:>6} {:>14} {:>12.2f} {:>14} {:>12.2f}'.format(depth, full_size, full_elapsed * 1000,
+                                                                  lean_size, lean_elapsed * 1000))
+    finally:
+        if client is not None:
+            client.drop_database('bench_pipeline')
+            client.close()
+
+
+if __name__ == '__main__':
+    main()